@@ -7,6 +7,7 @@ import torch_optimizer
 from typing import Dict, Tuple, Any
 from transformers import TrainingArguments, DistilBertForSequenceClassification, Trainer, BertForSequenceClassification
 from torch import nn
+from .trainer import BaseTrainer
 
 from transformers.utils import (
     ExplicitEnum,
@@ -453,8 +454,9 @@ class MyTrainingArguments:
         adafactor (`bool`, *optional*, defaults to `False`):
             This argument is deprecated. Use `--optim adafactor` instead.
         group_by_length (`bool`, *optional*, defaults to `False`):
-            Whether or not to group together samples of roughly the same length in the training dataset (to minimize
-            padding applied and be more efficient). Only useful if applying dynamic padding.
+            Whether or not to group together samples of roughly the same length in the training dataset, and to sort
+            the evaluation dataset by length (to minimize padding applied and be more efficient). Only useful if
+            applying dynamic padding. See [`~sampler.BucketSampler`].
         length_column_name (`str`, *optional*, defaults to `"length"`):
             Column name for precomputed lengths. If the column exists, grouping by length will use these values rather
             than computing them on train startup. Ignored unless `group_by_length` is `True` and the dataset is an
@@ -1818,15 +1820,11 @@ class ParallelMode(Enum):
     TPU = "tpu"
 
 
-class MyTrainer(Trainer):
+class MyTrainer(BaseTrainer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Add custom attributes here
 
-    def run_id(self):
-        run_id = self.hp_space(self._trial)['learning_rate']
-        return run_id
-
     def create_optimizer_and_scheduler(self, num_training_steps):
         self.create_optimizer()
         self.create_scheduler(
@@ -0,0 +1,140 @@
+import gc
+import math
+import resource
+import sys
+import threading
+import time
+
+import torch
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+# how the learning rate follows the batch size, as a function of the ratio of the new batch size to the old one
+lr_scaling_rules = {
+    "none": lambda ratio: 1.0,
+    # Goyal et al., 2017
+    "linear": lambda ratio: ratio,
+    # Krizhevsky, 2014, Hoffer et al., 2017
+    "sqrt": math.sqrt,
+}
+
+
+def resident_memory():
+    """
+    The current resident set size of the process in bytes, from `/proc/self/statm` on Linux, `None` elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class PeakMemory:
+    """
+    Context manager measuring the peak memory in bytes (`bytes`) of what runs in it: allocated by torch on `device` on a
+    GPU, its own growth of the resident set size of the process on CPU, i.e. the highest resident set size sampled
+    every `interval` seconds by a thread, minus the one at the start. Unlike the peak resident set size of the process
+    (`ru_maxrss`), which never goes down, the growth of a probe does not include the peaks of the probes before it. It
+    does not include the memory the process held before either, e.g. the model, so on CPU it is not comparable to the
+    GPU number. Without `/proc` (not Linux), the growth of `ru_maxrss` is used, which is 0 once an earlier probe peaked
+    higher.
+    """
+
+    def __init__(self, device, interval=0.001):
+        self.device = device
+        self.interval = interval
+        self.bytes = None
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self._peak = max(self._peak, resident_memory())
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return self
+        self._start = resident_memory()
+        if self._start is None:
+            self._start = _max_resident_memory()
+            return self
+        self._peak = self._start
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.device.type == "cuda":
+            self.bytes = torch.cuda.max_memory_allocated(self.device)
+        elif not hasattr(self, "_thread"):
+            self.bytes = _max_resident_memory() - self._start
+        else:
+            self._done.set()
+            self._thread.join()
+            self.bytes = max(self._peak, resident_memory()) - self._start
+        return False
+
+
+def _max_resident_memory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def is_out_of_memory(error):
+    return isinstance(error, MemoryError) or (
+        isinstance(error, RuntimeError)
+        and ("out of memory" in str(error) or "can't allocate memory" in str(error))
+    )
+
+
+def probe_batch_sizes(step, batch_sizes, device, steps=3, memory_limit=None):
+    """
+    Runs `step(batch_size)` once to warm up and `steps` more times for every batch size of `batch_sizes`, in
+    increasing order, and returns a list with the batch size, samples per second, peak memory of its steps (see
+    `PeakMemory`) and whether it fits of every batch size probed.
+
+    A batch size fits if it neither runs out of memory nor peaks above `memory_limit` bytes. Probing stops at the first
+    batch size that does not fit, or that is slower than a smaller one, as the larger ones would not be picked anyway.
+    """
+    results = []
+    for batch_size in sorted(batch_sizes):
+        peak = PeakMemory(device)
+        try:
+            with peak:
+                step(batch_size)
+                start = time.perf_counter()
+                for _ in range(steps):
+                    step(batch_size)
+                seconds = time.perf_counter() - start
+        except (RuntimeError, MemoryError) as e:
+            if not is_out_of_memory(e):
+                raise
+            results.append({"batch_size": batch_size, "samples_per_second": None, "peak_memory": None, "fits": False})
+            break
+        finally:
+            gc.collect()
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+        memory = peak.bytes
+        fits = memory_limit is None or memory <= memory_limit
+        results.append({"batch_size": batch_size, "samples_per_second": batch_size * steps / seconds,
+                        "peak_memory": memory, "fits": fits})
+        logger.info(f"batch size {batch_size}: {results[-1]['samples_per_second']:.1f} samples/s, "
+                    f"peak memory {memory / 2**20:.0f} MiB")
+        faster = [r["samples_per_second"] for r in results[:-1] if r["fits"]]
+        if not fits or (faster and results[-1]["samples_per_second"] < max(faster)):
+            break
+    return results
+
+
+def best_batch_size(results):
+    """
+    The batch size with the highest throughput among the `results` of `probe_batch_sizes` that fit.
+    """
+    fitting = [result for result in results if result["fits"]]
+    if not fitting:
+        raise RuntimeError(f"None of the batch sizes {[r['batch_size'] for r in results]} fits in memory.")
+    return max(fitting, key=lambda result: result["samples_per_second"])["batch_size"]
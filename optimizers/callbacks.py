@@ -0,0 +1,184 @@
+import math
+import statistics
+import time
+from collections import deque
+
+import torch
+from transformers import TrainerCallback
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+class TimeToTargetCallback(TrainerCallback):
+    """
+    A [`TrainerCallback`] that records the wall-clock time and the number of steps a run needs until the objective of
+    an evaluation reaches `target`, and stops the training there.
+
+    Args:
+        target (`float`):
+            The objective value that is good enough.
+        compute_objective (`Callable[[Dict[str, float]], float]`):
+            Computes the objective from the metrics of an evaluation.
+        greater_is_better (`bool`, *optional*, defaults to `True`):
+            Whether the objective has to reach `target` from below or from above.
+    """
+
+    def __init__(self, target, compute_objective, greater_is_better=True):
+        self.target = target
+        self.compute_objective = compute_objective
+        self.greater_is_better = greater_is_better
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.best = None
+        self.reached_target = False
+        self.seconds = None
+        self.steps = None
+
+    def is_better(self, value, other):
+        return value >= other if self.greater_is_better else value <= other
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.reset()
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        objective = self.compute_objective(metrics.copy())
+        if self.best is None or self.is_better(objective, self.best):
+            self.best = objective
+        if not self.reached_target and self.is_better(objective, self.target):
+            self.reached_target = True
+            self.seconds = time.time() - self.start
+            self.steps = state.global_step
+            control.should_training_stop = True
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not self.reached_target:
+            # the run never got there, it costs the whole training
+            self.seconds = time.time() - self.start
+            self.steps = state.global_step
+
+
+class DivergenceCallback(TrainerCallback):
+    """
+    A [`TrainerCallback`] that ends runs whose training diverges: as soon as the training loss or the gradient norm is
+    NaN/Inf, or when the median of the loss over the last `window` steps is above its value at the first step (the
+    untrained level) and more than `factor` times the lowest of that value and of the medians seen so far. The same
+    holds for the gradient norm, as long as the loss is not below its first value either.
+
+    A diverged trial of a hyperparameter search is pruned (`optuna.TrialPruned` is raised), so the study records it
+    and moves on to the next trial right away; any other run just stops training. The loss and the gradient norm of
+    every step are handed over by `BaseTrainer.training_step`.
+
+    Args:
+        window (`int`, *optional*, defaults to 50):
+            Number of steps the medians are taken over.
+        factor (`float`, *optional*, defaults to 10.0):
+            How much the median may grow over its lowest value before the run counts as diverged.
+    """
+
+    def __init__(self, window=50, factor=10.0):
+        self.window = window
+        self.factor = factor
+        self.reset()
+
+    def reset(self):
+        self.losses = deque(maxlen=self.window)
+        self.grad_norms = deque(maxlen=self.window)
+        # value at the first step (the untrained level) and lowest median of the loss and of the gradient norm
+        self.references = {}
+        self.reason = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.reset()
+
+    def blown_up(self, name, values):
+        if name not in self.references:
+            self.references[name] = (values[-1], values[-1])
+        if len(values) < self.window:
+            return False
+        median = statistics.median(values)
+        first, lowest = self.references[name]
+        self.references[name] = (first, min(lowest, median))
+        return median > self.factor * min(first, lowest) and median > first
+
+    def update(self, loss, model):
+        loss = loss.item()
+        grads = [p.grad.detach().norm() for p in model.parameters() if p.grad is not None]
+        grad_norm = torch.norm(torch.stack(grads)).item() if grads else 0.0
+        self.losses.append(loss)
+        self.grad_norms.append(grad_norm)
+        if not math.isfinite(loss) or not math.isfinite(grad_norm):
+            self.reason = "loss " + str(loss) + ", gradient norm " + str(grad_norm)
+            return
+        loss_blown_up = self.blown_up("loss", self.losses)
+        grad_norm_blown_up = self.blown_up("grad_norm", self.grad_norms)
+        # the gradient norm of a healthy run can grow a lot too, it only counts while the loss is not going down
+        stalled = statistics.median(self.losses) >= self.references["loss"][0]
+        if loss_blown_up or (grad_norm_blown_up and stalled):
+            self.reason = "median loss " + str(statistics.median(self.losses)) + ", median gradient norm " + \
+                          str(statistics.median(self.grad_norms)) + " over the last " + str(self.window) + " steps"
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.reason is None:
+            return
+        logger.warning(f"Training diverged at step {state.global_step}: {self.reason}.")
+        if state.is_hyper_param_search:
+            import optuna
+
+            raise optuna.TrialPruned(f"diverged at step {state.global_step}: {self.reason}")
+        control.should_training_stop = True
+
+
+class BestWeightsCallback(TrainerCallback):
+    """
+    A [`TrainerCallback`] that does what `load_best_model_at_end` does without checkpoints: the weights of the best
+    evaluation are copied to RAM, and loaded back into the model at the end of the training. Use it with
+    `save_strategy="no"` to skip the disk entirely.
+
+    The best evaluation is the one with the best `metric_for_best_model` of the training arguments (the evaluation
+    loss when it is not set), in the direction of `greater_is_better`, as for `load_best_model_at_end`.
+
+    Args:
+        dtype (`torch.dtype`, *optional*):
+            The floating point weights are kept in this type, e.g. `torch.float16` to halve the memory of the copy.
+            Defaults to the type of the model.
+    """
+
+    def __init__(self, dtype=None):
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        self.best = None
+        self.best_step = None
+        self.state_dict = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.reset()
+
+    def on_evaluate(self, args, state, control, metrics=None, model=None, **kwargs):
+        metric_name = args.metric_for_best_model or "loss"
+        if not metric_name.startswith("eval_"):
+            metric_name = "eval_" + metric_name
+        greater_is_better = args.greater_is_better
+        if greater_is_better is None:
+            greater_is_better = not metric_name.endswith("loss")
+        value = metrics[metric_name]
+        if self.best is not None and not (value > self.best if greater_is_better else value < self.best):
+            return
+        self.best = value
+        self.best_step = state.global_step
+        self.state_dict = {
+            name: tensor.detach().to("cpu", dtype=self.dtype if tensor.is_floating_point() else None, copy=True)
+            for name, tensor in model.state_dict().items()
+        }
+
+    def on_train_end(self, args, state, control, model=None, **kwargs):
+        if self.state_dict is None:
+            return
+        logger.info(f"Loading best model from step {self.best_step} ({self.best}).")
+        # load_state_dict copies into the parameters of the model, casting back to their type and device
+        model.load_state_dict(self.state_dict)
+        self.state_dict = None
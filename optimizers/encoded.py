@@ -0,0 +1,151 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class EncodedDataset(torch.utils.data.Dataset):
+    """
+    Tokenized examples and their labels kept in flat numpy buffers: the token ids of every model input of all the
+    examples one after the other, the offsets where every example starts and ends, and the labels, as Arrow keeps a
+    list column. The dataset is a view of some `rows` of the buffers (all of them by default), so that
+    [`~EncodedDataset.select`] makes the splits of every seed without copying them.
+
+    The `DataLoader` of torch (2.0 and later) gets the examples of a whole batch at once from `__getitems__`, which
+    reads all their tokens from the buffers with a single numpy indexing and hands every example views of them, so
+    no list of token ids is made. The examples are the ones of `__getitem__`, which any collator takes;
+    [`~EncodedDataset.collate`] pads them to the longest one of the batch.
+
+    The `"length"` column of the dataset (see [`~sampler.dataset_lengths`]) and its `"labels"` are read as
+    `dataset["length"]` and `dataset["labels"]`, without reading the examples.
+    """
+
+    def __init__(self, values, offsets, labels, pad_values=None, rows=None):
+        self.values = values
+        self.offsets = offsets
+        self.labels = labels
+        self.pad_values = pad_values or {}
+        self.rows = np.arange(len(labels)) if rows is None else np.asarray(rows, dtype=np.int64)
+        self.column_names = list(values) + ["attention_mask", "labels", "length"]
+
+    @classmethod
+    def from_encodings(cls, encodings, labels, tokenizer=None):
+        """
+        The dataset of the not padded `encodings` of a tokenizer and their `labels`. The attention masks are not kept,
+        they are ones up to the length of every example. The pad values are the ones of `tokenizer`, 0 by default.
+        """
+        lengths = np.fromiter((len(ids) for ids in encodings["input_ids"]), dtype=np.int64,
+                              count=len(encodings["input_ids"]))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = {
+            key: np.fromiter((i for ids in column for i in ids), dtype=np.int64, count=offsets[-1])
+            for key, column in encodings.items() if key != "attention_mask"
+        }
+        pad_values = {}
+        if tokenizer is not None:
+            pad_values = {"input_ids": tokenizer.pad_token_id, "token_type_ids": tokenizer.pad_token_type_id}
+        return cls(values, offsets, np.asarray(labels, dtype=np.int64), pad_values)
+
+    @classmethod
+    def from_dataset(cls, dataset, labels, tokenizer=None):
+        """
+        The dataset of the not padded encodings in the list columns of the `datasets.Dataset` `dataset` (e.g. made by
+        `map`) and `labels`, whose buffers are the ones of the Arrow columns, without going through python lists.
+        """
+        if dataset._indices is not None:
+            dataset = dataset.flatten_indices()
+        values, offsets = {}, None
+        for key in tokenizer.model_input_names if tokenizer is not None else ["input_ids"]:
+            if key == "attention_mask" or key not in dataset.column_names:
+                continue
+            column = dataset.data.column(key).combine_chunks()
+            if offsets is None:
+                offsets = np.asarray(column.offsets, dtype=np.int64)
+                offsets = offsets - offsets[0]
+            values[key] = np.asarray(column.flatten(), dtype=np.int64)
+        pad_values = {}
+        if tokenizer is not None:
+            pad_values = {"input_ids": tokenizer.pad_token_id, "token_type_ids": tokenizer.pad_token_type_id}
+        return cls(values, offsets, np.asarray(labels, dtype=np.int64), pad_values)
+
+    def save(self, directory):
+        """
+        Writes the buffers of the whole dataset (whatever its rows) to `directory`, see [`~EncodedDataset.load`].
+        """
+        os.makedirs(directory, exist_ok=True)
+        for key, values in self.values.items():
+            np.save(os.path.join(directory, key + ".npy"), values)
+        np.save(os.path.join(directory, "offsets.npy"), self.offsets)
+        np.save(os.path.join(directory, "labels.npy"), self.labels)
+        with open(os.path.join(directory, "dataset.json"), "w") as f:
+            json.dump({"inputs": list(self.values), "pad_values": self.pad_values}, f)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        The dataset [`~EncodedDataset.save`] wrote to `directory`, with its buffers memory-mapped: it opens at once,
+        its pages are read when a batch needs them and are shared by every process that loads it.
+        """
+        with open(os.path.join(directory, "dataset.json")) as f:
+            meta = json.load(f)
+
+        def load(name):
+            # copy on write, the pages stay shared as long as nothing writes to them
+            return np.load(os.path.join(directory, name + ".npy"), mmap_mode="c")
+
+        return cls({key: load(key) for key in meta["inputs"]}, load("offsets"), load("labels"), meta["pad_values"])
+
+    def select(self, rows):
+        """
+        The view of the rows `rows` of this dataset, sharing its buffers.
+        """
+        return type(self)(self.values, self.offsets, self.labels, self.pad_values, self.rows[np.asarray(rows)])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, str):
+            if idx == "labels":
+                return self.labels[self.rows]
+            if idx == "length":
+                return self.offsets[self.rows + 1] - self.offsets[self.rows]
+            raise KeyError(idx)
+        row = self.rows[idx]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        item = {key: torch.from_numpy(values[start:end]) for key, values in self.values.items()}
+        item["attention_mask"] = torch.ones(end - start, dtype=torch.int64)
+        item["labels"] = torch.tensor([self.labels[row]])
+        return item
+
+    def __getitems__(self, indices):
+        rows = self.rows[np.asarray(indices, dtype=np.int64)]
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        ends = np.cumsum(lengths)
+        # where every token of the batch is in the buffers, example after example
+        tokens = np.arange(ends[-1] if len(rows) else 0) + np.repeat(starts - (ends - lengths), lengths)
+        columns = {key: np.split(values[tokens], ends[:-1]) for key, values in self.values.items()}
+        labels = self.labels[rows]
+        items = []
+        for i, length in enumerate(lengths):
+            item = {key: torch.from_numpy(column[i]) for key, column in columns.items()}
+            item["attention_mask"] = torch.ones(length, dtype=torch.int64)
+            item["labels"] = torch.from_numpy(labels[i:i + 1])
+            items.append(item)
+        return items
+
+    def collate(self, features):
+        """
+        Data collator of the dataset: pads the examples to the longest one and stacks them.
+        """
+        batch = {}
+        for key in features[0]:
+            if key == "labels":
+                batch[key] = torch.stack([feature[key] for feature in features])
+            else:
+                batch[key] = torch.nn.utils.rnn.pad_sequence([feature[key] for feature in features], batch_first=True,
+                                                             padding_value=self.pad_values.get(key, 0))
+        return batch
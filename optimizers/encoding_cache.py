@@ -0,0 +1,149 @@
+import contextlib
+import fcntl
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+
+import datasets
+import transformers
+
+from .encoded import EncodedDataset
+from .tokenization import parallel_map
+
+# the cache of the host: every checkout of the repository, script and worker process shares it
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "nlp-optimizers", "encoded")
+# the modules of the package the encodings depend on, see `code_fingerprint`
+encoding_modules = ["tokenization", "encoded", "encoding_cache"]
+_code_fingerprint = None
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    What the encodings of `tokenizer` depend on: its name, class, maximum length and the versions of the libraries,
+    and for a fast tokenizer a hash of its whole definition (vocabulary, normalizer, special tokens).
+    """
+    fingerprint = {
+        "name": tokenizer.name_or_path,
+        "class": type(tokenizer).__name__,
+        "model_max_length": tokenizer.model_max_length,
+        "transformers": transformers.__version__,
+    }
+    if getattr(tokenizer, "is_fast", False):
+        import tokenizers
+
+        fingerprint["tokenizers"] = tokenizers.__version__
+        fingerprint["definition"] = hashlib.sha256(tokenizer.backend_tokenizer.to_str().encode()).hexdigest()
+    return fingerprint
+
+
+def code_fingerprint():
+    """
+    Hash of the source of the `encoding_modules`, which the encodings depend on besides the function mapped (e.g. the
+    [`~tokenization.PairEncoder`] a `preprocess_function` calls, and how they are computed and stored), computed once
+    per process.
+    """
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        h = hashlib.sha256()
+        for name in encoding_modules:
+            h.update(inspect.getsource(importlib.import_module("." + name, __package__)).encode())
+        _code_fingerprint = h.hexdigest()
+    return _code_fingerprint
+
+
+def encoding_key(tokenizer, task, function, data, **config):
+    """
+    The key of the encodings of `data` (the fingerprint of a dataset or a hash of the texts) by `function` (by its
+    source) with `tokenizer` (see `tokenizer_fingerprint`) for `task`, and anything else in `config`, e.g. the
+    maximum length. The key also covers the code of this package the encodings depend on, see `code_fingerprint`.
+    """
+    source = inspect.getsource(function) if callable(function) else function
+    key = dict(config, tokenizer=tokenizer_fingerprint(tokenizer), task=task, function=source, data=data,
+               code=code_fingerprint())
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def _locked(path):
+    # held by the process computing an entry, the others wait for it and read the entry instead of computing it too
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cached(cache_dir, key, build, save, load):
+    """
+    `load(entry)` of the entry `key` of `cache_dir`, after writing it with `save(build(directory), directory)` if it is
+    not there, where `directory` becomes the entry. Only one process builds an entry, the entry appears at once when it
+    is complete. Without `cache_dir`, returns `build(None)`.
+    """
+    if not cache_dir:
+        return build(None)
+    entry = os.path.join(cache_dir, key)
+    if not os.path.exists(entry):
+        with _locked(entry):
+            if not os.path.exists(entry):
+                tmp = tempfile.mkdtemp(prefix=key + "_", dir=cache_dir)
+                try:
+                    save(build(tmp), tmp)
+                    os.replace(tmp, entry)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+    return load(entry)
+
+
+def _map_file(directory):
+    # where the processes of a map write their parts, in the entry being built, they are removed once it is saved
+    if directory is None:
+        return None
+    os.makedirs(os.path.join(directory, "map"))
+    return os.path.join(directory, "map", "encoded.arrow")
+
+
+def cached_map(dataset, function, tokenizer, task, cache_dir=default_cache_dir, num_proc=None, **config):
+    """
+    `dataset.map(function, batched=True)`, computed once per host: the result is stored in `cache_dir` under the
+    fingerprint of `dataset` (the same for the same source data and transforms, e.g. splits with the same seed) and
+    `encoding_key`, and is loaded memory-mapped, so it opens at once and its pages are shared by every process reading
+    it. The map is split across `num_proc` processes (see [`~tokenization.parallel_map`]), which write their parts
+    next to the entry being built.
+    """
+    key = encoding_key(tokenizer, task, function, dataset._fingerprint, **config)
+
+    def save(encoded, entry):
+        encoded.save_to_disk(entry)
+        shutil.rmtree(os.path.join(entry, "map"))
+
+    return cached(cache_dir, key,
+                  lambda directory: parallel_map(dataset, function, num_proc, cache_file_name=_map_file(directory)),
+                  save, datasets.load_from_disk)
+
+
+def cached_encode(texts, labels, tokenizer, task, cache_dir=default_cache_dir, num_proc=None, **kwargs):
+    """
+    The [`~encoded.EncodedDataset`] of `tokenizer(texts, **kwargs)` (not padded) and `labels`, computed once per host
+    in `num_proc` processes and memory-mapped, see `cached_map`. The key hashes the texts and labels themselves.
+    """
+    texts = list(texts)
+    data = hashlib.sha256(json.dumps([texts, [int(label) for label in labels]]).encode()).hexdigest()
+    key = encoding_key(tokenizer, task, "tokenizer(texts)", data, **kwargs)
+
+    def build(directory):
+        encoded = parallel_map(datasets.Dataset.from_dict({"text": texts}),
+                               lambda examples: tokenizer(examples["text"], **kwargs), num_proc,
+                               cache_file_name=_map_file(directory))
+        return EncodedDataset.from_dataset(encoded, labels, tokenizer)
+
+    def save(encoded, entry):
+        encoded.save(entry)
+        shutil.rmtree(os.path.join(entry, "map"))
+
+    return cached(cache_dir, key, build, save, EncodedDataset.load)
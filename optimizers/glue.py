@@ -0,0 +1,181 @@
+import csv
+import hashlib
+import json
+import os
+
+import datasets
+import numpy as np
+import pyarrow as pa
+from datasets import ClassLabel, Dataset, DatasetDict, Features, Value
+from datasets.arrow_writer import ArrowWriter
+
+from .encoding_cache import cached, default_cache_dir
+
+dataDir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data'))
+
+# the files of every task as the GLUE download script writes them, with the columns and labels of the `glue` dataset of
+# the hub: its feature name -> column of the files, the label column, the label names (a float label without them), and
+# its split -> file (the first one of the directory that exists)
+glue_tasks = {
+    "cola": {
+        "dirs": ["CoLA", "COLA"],
+        "text": {"sentence": "sentence"},
+        "label": "is_acceptable",
+        "names": ["unacceptable", "acceptable"],
+        # without header: source, label, original label, sentence
+        "columns": ["source", "is_acceptable", "original_label", "sentence"],
+        "splits": {"train": ["train.tsv"], "validation": ["dev.tsv"], "test": ["test.tsv"]},
+    },
+    "mrpc": {
+        "dirs": ["MRPC"],
+        "text": {"sentence1": "#1 String", "sentence2": "#2 String"},
+        "label": "Quality",
+        "names": ["not_equivalent", "equivalent"],
+        # the test set of the hub has the labels of the original corpus, test.tsv of GLUE does not
+        "splits": {"train": ["train.tsv"], "validation": ["dev.tsv"], "test": ["msr_paraphrase_test.txt", "test.tsv"]},
+    },
+    "mnli": {
+        "dirs": ["MNLI"],
+        "text": {"premise": "sentence1", "hypothesis": "sentence2"},
+        "label": "gold_label",
+        "names": ["entailment", "neutral", "contradiction"],
+        "splits": {
+            "train": ["train.tsv"],
+            "validation_matched": ["dev_matched.tsv"],
+            "validation_mismatched": ["dev_mismatched.tsv"],
+            "test_matched": ["test_matched.tsv"],
+            "test_mismatched": ["test_mismatched.tsv"],
+        },
+    },
+    "stsb": {
+        "dirs": ["STS-B", "STSB"],
+        "text": {"sentence1": "sentence1", "sentence2": "sentence2"},
+        "label": "score",
+        "names": None,
+        "splits": {"train": ["train.tsv"], "validation": ["dev.tsv"], "test": ["test.tsv"]},
+    },
+}
+
+
+def task_dir(task, data_dir=dataDir):
+    """
+    The directory of `task` under `data_dir`, or `None` if it has none.
+    """
+    for name in glue_tasks[task]["dirs"]:
+        if os.path.isdir(os.path.join(data_dir, name)):
+            return os.path.join(data_dir, name)
+    return None
+
+
+def task_files(task, directory):
+    # split -> path of its file, the splits without a file are left out
+    files = {}
+    for split, names in glue_tasks[task]["splits"].items():
+        paths = [os.path.join(directory, name) for name in names if os.path.exists(os.path.join(directory, name))]
+        if paths:
+            files[split] = paths[0]
+    return files
+
+
+def _read_examples(task, path):
+    # the examples of the file one by one, before encoding the label names
+    spec = glue_tasks[task]
+    with open(path, encoding="utf8") as f:
+        if "columns" in spec and not f.readline().startswith("index"):
+            f.seek(0)
+            reader = csv.DictReader(f, fieldnames=spec["columns"], delimiter="\t", quoting=csv.QUOTE_NONE)
+        else:
+            f.seek(0)
+            reader = csv.DictReader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+        for n, row in enumerate(reader):
+            example = {name: row.get(column) for name, column in spec["text"].items()}
+            label = row.get(spec["label"], -1)
+            if spec["names"] is None:
+                label = np.float32(label) if label is not None else None
+            elif label not in spec["names"]:
+                label = int(label) if label else None
+            example["label"] = label
+            example["idx"] = n
+            if any(value is None for value in example.values()):
+                continue
+            yield example
+
+
+def read_split(task, path, arrow_path=None):
+    """
+    The examples of the GLUE file `path` of `task`, as the `glue` dataset of the hub reads them: rows with missing
+    fields are left out, `idx` counts the rows read and the label is -1 in files without labels. The examples are
+    written to the Arrow file `arrow_path` as they are read, a batch at a time, and the dataset is memory-mapped from
+    it, so that reading a split never holds all of its rows in memory. Without `arrow_path`, the dataset is in memory.
+    """
+    spec = glue_tasks[task]
+    features = {name: Value("string") for name in spec["text"]}
+    features["label"] = Value("float32") if spec["names"] is None else ClassLabel(names=spec["names"])
+    features["idx"] = Value("int32")
+    features = Features(features)
+    stream = None if arrow_path else pa.BufferOutputStream()
+    writer = ArrowWriter(features=features, path=arrow_path, stream=stream)
+    try:
+        for example in _read_examples(task, path):
+            writer.write(features.encode_example(example))
+        writer.finalize()
+    finally:
+        writer.close()
+    return Dataset.from_file(arrow_path) if arrow_path else Dataset.from_buffer(stream.getvalue())
+
+
+def load_glue(task, data_dir=dataDir, cache_dir=default_cache_dir):
+    """
+    The splits of the GLUE `task` as `load_dataset("glue", task)` returns them, read from the files of the GLUE
+    download under `data_dir` (e.g. `data/CoLA/train.tsv`, see `glue_tasks`) without any network access. The files are
+    read once per host and streamed to Arrow files in `cache_dir` (see `read_split`), under a hash of their paths,
+    sizes and modification times, which every later run opens memory-mapped: only the columns and rows a run reads
+    are loaded, e.g. the labels of the whole MNLI training set and the pairs of a subset of it. Without a directory for
+    `task` under `data_dir`, the dataset is loaded from the hub.
+    """
+    directory = task_dir(task, data_dir)
+    if directory is None:
+        return datasets.load_dataset("glue", task)
+    files = task_files(task, directory)
+    stats = {split: [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+             for split, path in files.items()}
+    key = "glue-" + hashlib.sha256(json.dumps([task, "arrow", stats], sort_keys=True).encode()).hexdigest()
+
+    def build(entry):
+        # in memory without a cache
+        return DatasetDict({split: read_split(task, path, entry and os.path.join(entry, split + ".arrow"))
+                            for split, path in files.items()})
+
+    def load(entry):
+        return DatasetDict({split: Dataset.from_file(os.path.join(entry, split + ".arrow")) for split in files})
+
+    # the splits are written to the entry as they are read
+    return cached(cache_dir, key, build, lambda dataset, entry: None, load)
+
+
+class GlueMetric:
+    """
+    The metric of the GLUE `task`, with the same `compute` and results as `load_metric("glue", task)`, without
+    downloading it.
+    """
+
+    def __init__(self, task):
+        self.task = task
+
+    def compute(self, predictions, references):
+        from scipy.stats import pearsonr, spearmanr
+        from sklearn.metrics import f1_score, matthews_corrcoef
+
+        predictions, references = np.asarray(predictions), np.asarray(references)
+        if self.task == "cola":
+            return {"matthews_correlation": float(matthews_corrcoef(references, predictions))}
+        if self.task == "stsb":
+            return {"pearson": float(pearsonr(predictions, references)[0]),
+                    "spearmanr": float(spearmanr(predictions, references)[0])}
+        results = {"accuracy": float((predictions == references).mean())}
+        if self.task == "mrpc":
+            results["f1"] = float(f1_score(y_true=references, y_pred=predictions))
+        return results
+
+    def __repr__(self):
+        return f"GlueMetric(task={self.task!r})"
@@ -0,0 +1,137 @@
+import math
+
+import numpy as np
+import torch
+from torch import nn
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+# the model types `packed_forward` runs, the ones of the scripts and BERT
+packed_model_types = ("bert", "distilbert", "roberta")
+
+
+def _examples(features):
+    # the token ids, token type ids and label of every example
+    return [{key: value.tolist() if torch.is_tensor(value) else value
+             for key, value in feature.items() if key != "attention_mask"} for feature in features]
+
+
+class PackingCollator:
+    """
+    Data collator packing the examples of a batch into rows of at most `pack_length` tokens, in their order: every
+    example goes after the previous one in the current row if it fits, and opens a new row otherwise, so the examples
+    of the rows of a [`~sampler.PackedBatchSampler`] fill the same rows. The rows are padded to the longest one.
+
+    Besides the `input_ids` (and `token_type_ids`) of the rows, the batch has the `position_ids` of every token in its
+    example (from 0), the `segment_ids` telling the examples of a row apart (from 1, 0 for padding) and the `labels` of
+    the examples in their order, for [`~packing.packed_forward`], which attends within every example only and
+    classifies every example from its first token.
+    """
+
+    def __init__(self, pack_length, pad_token_id=0):
+        self.pack_length = pack_length
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features):
+        examples = _examples(features)
+        rows = []
+        for example in examples:
+            length = len(example["input_ids"])
+            if not rows or rows[-1][0] + length > self.pack_length:
+                rows.append([0, []])
+            rows[-1][0] += length
+            rows[-1][1].append(example)
+        shape = (len(rows), max(used for used, _ in rows))
+        input_ids = np.full(shape, self.pad_token_id, dtype=np.int64)
+        token_type_ids = np.zeros(shape, dtype=np.int64)
+        position_ids = np.zeros(shape, dtype=np.int64)
+        segment_ids = np.zeros(shape, dtype=np.int64)
+        for i, (_, row) in enumerate(rows):
+            start = 0
+            for segment, example in enumerate(row, start=1):
+                end = start + len(example["input_ids"])
+                input_ids[i, start:end] = example["input_ids"]
+                if "token_type_ids" in example:
+                    token_type_ids[i, start:end] = example["token_type_ids"]
+                position_ids[i, start:end] = np.arange(end - start)
+                segment_ids[i, start:end] = segment
+                start = end
+        batch = {
+            "input_ids": torch.from_numpy(input_ids),
+            "position_ids": torch.from_numpy(position_ids),
+            "segment_ids": torch.from_numpy(segment_ids),
+        }
+        if "token_type_ids" in examples[0]:
+            batch["token_type_ids"] = torch.from_numpy(token_type_ids)
+        label = "labels" if "labels" in examples[0] else "label"
+        if label in examples[0]:
+            batch["labels"] = torch.tensor([example[label] for example in examples])
+        return batch
+
+
+def _distilbert_hidden_states(distilbert, input_ids, position_ids, mask):
+    # the forward of `DistilBertModel`, whose attention only takes a mask of the keys, with the positions and the mask
+    # of the keys of every query given
+    embeddings = distilbert.embeddings
+    x = embeddings.word_embeddings(input_ids) + embeddings.position_embeddings(position_ids)
+    x = embeddings.dropout(embeddings.LayerNorm(x))
+    masked = ~mask[:, None]
+    for layer in distilbert.transformer.layer:
+        attention = layer.attention
+        bs, length, dim = x.size()
+        dim_per_head = attention.dim // attention.n_heads
+
+        def shape(t):
+            return t.view(bs, -1, attention.n_heads, dim_per_head).transpose(1, 2)
+
+        q = shape(attention.q_lin(x)) / math.sqrt(dim_per_head)
+        k = shape(attention.k_lin(x))
+        v = shape(attention.v_lin(x))
+        scores = torch.matmul(q, k.transpose(2, 3))
+        scores = scores.masked_fill(masked, torch.tensor(torch.finfo(scores.dtype).min))
+        weights = attention.dropout(nn.functional.softmax(scores, dim=-1))
+        context = torch.matmul(weights, v).transpose(1, 2).contiguous().view(bs, -1, attention.n_heads * dim_per_head)
+        x = layer.sa_layer_norm(attention.out_lin(context) + x)
+        x = layer.output_layer_norm(layer.ffn(x) + x)
+    return x
+
+
+def packed_forward(model, inputs):
+    """
+    The output of the `AutoModelForSequenceClassification` `model` (see `packed_model_types`) for every example of the
+    packed batch `inputs` of a [`~packing.PackingCollator`], as if every example was a row of its own: the attention
+    mask is block-diagonal (every token attends to the tokens of its own example only), the position ids start over
+    at every example, and the classification head gets the first token ([CLS] or <s>) of every example. The loss is the
+    one of the model, the mean over the examples.
+    """
+    input_ids, position_ids, segment_ids = inputs["input_ids"], inputs["position_ids"], inputs["segment_ids"]
+    mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0)
+    # the first token of every example, in the order of the examples
+    starts = (segment_ids > 0) & (position_ids == 0)
+    model_type = model.config.model_type
+    if model_type == "distilbert":
+        hidden_states = _distilbert_hidden_states(model.distilbert, input_ids, position_ids, mask)
+    elif model_type in ("bert", "roberta"):
+        if model_type == "roberta":
+            # the positions of RoBERTa start after the one of the padding
+            position_ids = position_ids + model.config.pad_token_id + 1
+        hidden_states = model.base_model(input_ids, attention_mask=mask.long(), position_ids=position_ids,
+                                         token_type_ids=inputs.get("token_type_ids"))[0]
+    else:
+        raise ValueError(f"Packed batches are not supported for {model_type} models, only {packed_model_types}.")
+
+    features = hidden_states[starts]
+    if model_type == "distilbert":
+        logits = model.classifier(model.dropout(nn.functional.relu(model.pre_classifier(features))))
+    elif model_type == "bert":
+        logits = model.classifier(model.dropout(model.bert.pooler(features[:, None])))
+    else:
+        logits = model.classifier(features[:, None])
+
+    loss = None
+    labels = inputs.get("labels")
+    if labels is not None:
+        if model.num_labels == 1:
+            loss = nn.functional.mse_loss(logits.squeeze(-1), labels.float().view(-1))
+        else:
+            loss = nn.functional.cross_entropy(logits.view(-1, model.num_labels), labels.view(-1))
+    return SequenceClassifierOutput(loss=loss, logits=logits)
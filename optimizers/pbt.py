@@ -0,0 +1,234 @@
+import copy
+import math
+import os
+import random
+import threading
+
+from transformers import TrainerCallback
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+# hyperparameters of the search spaces that live in the param groups of the optimizers, under another name
+param_group_keys = {
+    "adam_epsilon": "eps",
+    "momentum_decay": "momentum_decay",
+    "final_lr": "final_lr",
+    "gamma": "gamma",
+    "momentum": "momentum",
+}
+
+
+def set_hyperparameters(optimizer, lr_scheduler, params, lr_scale=1.0):
+    """
+    Changes the hyperparameters of an optimizer in the middle of the training. The learning rate keeps following the
+    schedule, only its base value changes, to the one in `params` multiplied by `lr_scale`.
+    """
+    for i, group in enumerate(optimizer.param_groups):
+        if "learning_rate" in params:
+            learning_rate = params["learning_rate"] * lr_scale
+            scale = group["lr"] / group["initial_lr"] if group.get("initial_lr") else 1.0
+            group["initial_lr"] = learning_rate
+            group["lr"] = learning_rate * scale
+            if lr_scheduler is not None:
+                lr_scheduler.base_lrs[i] = learning_rate
+        if "betas" in group:
+            group["betas"] = (params.get("adam_beta1", group["betas"][0]), params.get("adam_beta2", group["betas"][1]))
+        for name, key in param_group_keys.items():
+            if name in params and key in group:
+                group[key] = params[name]
+
+
+class PopulationBasedTraining:
+    """
+    Population based training (Jaderberg et al., 2017) of several copies of a model in the same process.
+
+    Every member is trained by its own [`Trainer`] in its own thread, from a model built before the threads start (see
+    [`~BaseTrainer.population_based_training`]) and with a data order of its own. At every evaluation the members still
+    training wait for each other, then the ``quantile`` worst ones take the weights and the optimizer state of a random
+    member of the ``quantile`` best ones (exploit), and a perturbed version of its hyperparameters (explore): every
+    hyperparameter is multiplied by one of ``factors``, or, with probability ``resample_probability``, sampled again
+    from the search space.
+
+    Args:
+        trainers (`List[Trainer]`): The trainers of the members.
+        params (`List[Dict[str, float]]`): The initial hyperparameters of the members.
+        distributions (`Dict[str, optuna.distributions.BaseDistribution]`): The search space of the hyperparameters.
+        compute_objective (`Callable[[Dict[str, float]], float]`): Computes the objective from the metrics.
+        direction (`str`, *optional*, defaults to `"maximize"`): Whether the objective is maximized or minimized.
+        quantile (`float`, *optional*, defaults to 0.25): Fraction of the population that is replaced at every
+            evaluation.
+        factors (`Tuple[float]`, *optional*, defaults to `(0.8, 1.2)`): The perturbation factors.
+        resample_probability (`float`, *optional*, defaults to 0.25): Probability to resample a hyperparameter
+            instead of perturbing it.
+        seed (`int`, *optional*, defaults to 42): Seed of the exploit/explore decisions.
+        lr_scale (`float`, *optional*, defaults to 1.0): What the learning rates of `params` are multiplied by when
+            they are applied, see [`~BaseTrainer.find_batch_sizes`].
+    """
+
+    def __init__(self, trainers, params, distributions, compute_objective, direction="maximize", quantile=0.25,
+                 factors=(0.8, 1.2), resample_probability=0.25, seed=42, lr_scale=1.0):
+        self.trainers = trainers
+        self.params = params
+        self.distributions = distributions
+        self.compute_objective = compute_objective
+        self.maximize = direction == "maximize"
+        self.quantile = quantile
+        self.factors = factors
+        self.resample_probability = resample_probability
+        self.rng = random.Random(seed)
+        self.lr_scale = lr_scale
+
+        self.objectives = [None] * len(trainers)
+        self.states = [None] * len(trainers)
+        # best objective seen by every member, with the hyperparameters it was reached with
+        self.best = [(None, None)] * len(trainers)
+        self.history = []
+        # members wait for each other at every evaluation, members that are done training (or stopped early, e.g. by
+        # `DivergenceCallback`) leave the population
+        self.condition = threading.Condition()
+        self.active = set(range(len(trainers)))
+        self.waiting = set()
+        self.generation = 0
+        self.aborted = False
+        for i, trainer in enumerate(trainers):
+            trainer.add_callback(PBTCallback(self, i))
+
+    def is_better(self, value, other):
+        return value > other if self.maximize else value < other
+
+    def report(self, index, metrics, model, optimizer, lr_scheduler):
+        objective = self.compute_objective(metrics.copy())
+        self.objectives[index] = objective
+        self.states[index] = (model, optimizer, lr_scheduler)
+        if math.isfinite(objective) and (self.best[index][0] is None or self.is_better(objective, self.best[index][0])):
+            self.best[index] = (objective, dict(self.params[index]))
+        with self.condition:
+            self.waiting.add(index)
+            generation = self.generation
+            self.release()
+            while self.generation == generation and not self.aborted:
+                self.condition.wait()
+            if self.aborted:
+                raise threading.BrokenBarrierError
+
+    def release(self):
+        # called with `condition` held, once every active member has reported
+        if not self.waiting or not self.waiting >= self.active:
+            return
+        self.exploit_and_explore(sorted(self.waiting))
+        self.waiting.clear()
+        self.generation += 1
+        self.condition.notify_all()
+
+    def leave(self, index):
+        with self.condition:
+            self.active.discard(index)
+            self.release()
+
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+    def sample(self, name):
+        distribution = self.distributions[name]
+        if distribution.log:
+            return math.exp(self.rng.uniform(math.log(distribution.low), math.log(distribution.high)))
+        return self.rng.uniform(distribution.low, distribution.high)
+
+    def explore(self, params):
+        new_params = {}
+        for name, value in params.items():
+            if self.rng.random() < self.resample_probability:
+                new_params[name] = self.sample(name)
+            else:
+                distribution = self.distributions[name]
+                new_params[name] = min(max(value * self.rng.choice(self.factors), distribution.low), distribution.high)
+        return new_params
+
+    def rank(self, index):
+        objective = self.objectives[index]
+        if not math.isfinite(objective):
+            # diverged members are the worst ones
+            return -math.inf if self.maximize else math.inf
+        return objective
+
+    def exploit_and_explore(self, members):
+        ranking = sorted(members, key=self.rank, reverse=self.maximize)
+        n = max(1, int(len(ranking) * self.quantile)) if len(ranking) > 1 else 0
+        top, bottom = ranking[:n], ranking[len(ranking) - n:]
+        step = self.trainers[ranking[0]].state.global_step
+        for i in bottom:
+            j = self.rng.choice(top)
+            model, optimizer, lr_scheduler = self.states[i]
+            top_model, top_optimizer, _ = self.states[j]
+            # copied into the parameters of the member
+            model.load_state_dict(top_model.state_dict())
+            # the optimizer takes the tensors of the state as they are, the members must not share them
+            optimizer.load_state_dict(copy.deepcopy(top_optimizer.state_dict()))
+            self.params[i] = self.explore(self.params[j])
+            set_hyperparameters(optimizer, lr_scheduler, self.params[i], lr_scale=self.lr_scale)
+            for key, value in self.params[i].items():
+                setattr(self.trainers[i].args, key, value)
+            if "learning_rate" in self.params[i]:
+                self.trainers[i].args.learning_rate = self.params[i]["learning_rate"] * self.lr_scale
+            logger.info(f"PBT step {step}: member {i} ({self.objectives[i]}) <- member {j} ({self.objectives[j]}), "
+                        f"{self.params[i]}")
+        self.history.append({"step": step, "objectives": list(self.objectives),
+                             "params": [dict(p) for p in self.params]})
+
+    def train(self):
+        errors = []
+
+        def run(index, trainer):
+            try:
+                trainer.train()
+            except threading.BrokenBarrierError:
+                pass
+            except BaseException as e:
+                errors.append(e)
+                # the other members would wait for this one forever
+                self.abort()
+            finally:
+                self.leave(index)
+
+        threads = [threading.Thread(target=run, args=(i, trainer)) for i, trainer in enumerate(self.trainers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return self.best
+
+
+class PBTCallback(TrainerCallback):
+    """
+    A [`TrainerCallback`] that hands the evaluations of a member over to its [`PopulationBasedTraining`].
+    """
+
+    def __init__(self, population, index):
+        self.population = population
+        self.index = index
+
+    def on_evaluate(self, args, state, control, metrics=None, model=None, optimizer=None, lr_scheduler=None,
+                    **kwargs):
+        self.population.report(self.index, metrics, model, optimizer, lr_scheduler)
+
+
+def member_args(args, index, params, lr_scale=1.0):
+    args = copy.deepcopy(args)
+    args.output_dir = os.path.join(args.output_dir, "member-" + str(index))
+    if args.logging_dir is not None:
+        args.logging_dir = os.path.join(args.logging_dir, "member-" + str(index))
+    # members start from different initializations of the classification head
+    args.seed = args.seed + index
+    # and shuffle the data with a generator of their own, `Trainer` would seed it from the global one
+    if args.data_seed is None:
+        args.data_seed = args.seed
+    for key, value in params.items():
+        setattr(args, key, value)
+    if "learning_rate" in params:
+        args.learning_rate = params["learning_rate"] * lr_scale
+    return args
@@ -0,0 +1,42 @@
+import torch
+from transformers import AutoModelForSequenceClassification
+from transformers.modeling_utils import no_init_weights, set_initialized_submodules
+
+# (checkpoint, arguments) -> (config, pretrained weights), loaded once per process
+_cache = {}
+
+
+def load_pretrained(checkpoint, **kwargs):
+    """
+    Returns the config of `AutoModelForSequenceClassification.from_pretrained(checkpoint, **kwargs)` and a copy of the
+    weights it loads from the checkpoint, i.e. without the newly initialized ones of the classification head. The
+    checkpoint is read only the first time.
+    """
+    key = (checkpoint, tuple(sorted(kwargs.items())))
+    if key not in _cache:
+        # loading must not consume random numbers, the models built from the cache initialize their heads themselves
+        with torch.random.fork_rng():
+            model, info = AutoModelForSequenceClassification.from_pretrained(checkpoint, output_loading_info=True,
+                                                                             **kwargs)
+        new = set(info["missing_keys"]) | {name for name, _, _ in info["mismatched_keys"]}
+        state_dict = {name: tensor.detach().clone() for name, tensor in model.state_dict().items() if name not in new}
+        _cache[key] = (model.config, state_dict)
+    return _cache[key]
+
+
+def cached_from_pretrained(checkpoint, **kwargs):
+    """
+    Same as `AutoModelForSequenceClassification.from_pretrained(checkpoint, **kwargs)`, for `model_init`: the weights
+    are copied from a process-level cache instead of being read from the checkpoint for every trial, and the
+    classification head is initialized from the current random state, as `from_pretrained` does, so every seed gets
+    the same fresh head it would get from `from_pretrained`.
+    """
+    config, state_dict = load_pretrained(checkpoint, **kwargs)
+    with no_init_weights(_enable=True):
+        model = AutoModelForSequenceClassification.from_config(config)
+    # the same initialization as from_pretrained: only the modules without pretrained weights, in the same order
+    set_initialized_submodules(model, state_dict.keys())
+    model.apply(model._initialize_weights)
+    model.load_state_dict(state_dict, strict=False)
+    model.eval()
+    return model
@@ -0,0 +1,106 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import datasets
+import torch
+import transformers
+
+rootDir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+# the code the results depend on, relative to the root of the repository
+sources = ["optimizers", "tuning", "train"]
+# arguments of the training that do not change its results
+ignored_arguments = ["output_dir", "logging_dir", "run_name", "disable_tqdm"]
+# arguments of the scripts that do not change their results, --hparams is in the training arguments it sets
+ignored_script_arguments = ["run_root", "keep", "cache", "data_cache", "tokenize_procs", "rerun", "hparams"]
+
+_fingerprint = None
+
+
+def code_fingerprint():
+    """
+    Hash of the python files of `sources` and of the versions of the libraries the results depend on, computed once
+    per process.
+    """
+    global _fingerprint
+    if _fingerprint is None:
+        h = hashlib.sha256()
+        for version in (torch.__version__, transformers.__version__, datasets.__version__):
+            h.update(version.encode())
+        for source in sources:
+            for path in sorted(glob.glob(os.path.join(rootDir, source, "**", "*.py"), recursive=True)):
+                h.update(os.path.relpath(path, rootDir).encode())
+                with open(path, "rb") as f:
+                    h.update(f.read())
+        _fingerprint = h.hexdigest()
+    return _fingerprint
+
+
+def run_config(training_args, trainer_cls, script_args, train_dataset=None, eval_dataset=None):
+    """
+    The configuration of a training run, known before its data is tokenized and its trainer is built: the
+    `training_args` the script set (but the directories), the class and arguments of the optimizer `trainer_cls` makes
+    of them, the arguments of the script (an `argparse.Namespace`) but the ones of `ignored_script_arguments`, and the
+    fingerprints of the datasets.
+
+    The batch sizes picked by `--auto_batch_size` (and the learning rate and steps that follow them) depend on the
+    timing and memory of the probes, so the arguments of the probing are in the key instead of what it picks.
+    """
+    args = {k: v for k, v in training_args.to_dict().items() if k not in ignored_arguments}
+    optimizer_cls, optimizer_kwargs = trainer_cls.get_optimizer_cls_and_kwargs(training_args)
+    return {
+        "training_args": args,
+        "optimizer": optimizer_cls.__module__ + "." + optimizer_cls.__name__,
+        "optimizer_kwargs": optimizer_kwargs,
+        "script_args": {k: v for k, v in vars(script_args).items() if k not in ignored_script_arguments},
+        # the fingerprint of a `datasets.Dataset` follows the transforms it went through, e.g. the split and its seed
+        "train_dataset": getattr(train_dataset, "_fingerprint", None),
+        "eval_dataset": getattr(eval_dataset, "_fingerprint", None),
+    }
+
+
+def result_key(config):
+    """
+    The key of the results of a run with `config` (anything json can write, with `str` for the rest) and the current
+    code, see `code_fingerprint`.
+    """
+    config = json.dumps(dict(config, code=code_fingerprint()), sort_keys=True, default=str)
+    return hashlib.sha256(config.encode()).hexdigest()
+
+
+def entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def restore_result(cache_dir, key, files, directory="."):
+    """
+    Copies the `files` stored under `key` in `cache_dir` to `directory` and returns `True`, or returns `False` if there
+    are none.
+    """
+    entry = entry_dir(cache_dir, key)
+    if not all(os.path.exists(os.path.join(entry, os.path.basename(file))) for file in files):
+        return False
+    for file in files:
+        shutil.copyfile(os.path.join(entry, os.path.basename(file)), os.path.join(directory, file))
+    return True
+
+
+def store_result(cache_dir, key, config, files, directory="."):
+    """
+    Stores the `files` of `directory` a run with `config` wrote under `key` in `cache_dir`, with the config next to
+    them. The entry appears at once, so a run that is stopped while storing never leaves half of it.
+    """
+    entry = entry_dir(cache_dir, key)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=key + "_", dir=os.path.dirname(entry))
+    for file in files:
+        shutil.copyfile(os.path.join(directory, file), os.path.join(tmp, os.path.basename(file)))
+    with open(os.path.join(tmp, "config.json"), "w") as f:
+        json.dump(dict(config, code=code_fingerprint()), f, indent=2, sort_keys=True, default=str)
+    if os.path.exists(entry):
+        # the same run finished twice
+        shutil.rmtree(entry)
+    os.replace(tmp, entry)
@@ -0,0 +1,59 @@
+import glob
+import os
+import shutil
+import tempfile
+import uuid
+
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+# what a run can leave behind, see `clean_run_dir`
+artifacts = ["checkpoints", "logs"]
+
+
+def make_run_dir(root, name):
+    """
+    Creates a new directory for a run under `root` (e.g. `/dev/shm` to keep the checkpoints of the trials in memory),
+    named after `name` with a unique suffix, so that concurrent runs with the same name never share it.
+    """
+    os.makedirs(root, exist_ok=True)
+    return tempfile.mkdtemp(prefix=name + "_", dir=root)
+
+
+def run_dir_name(root, name):
+    """
+    The path of a new directory for a run under `root`, named after `name` with a unique suffix as in `make_run_dir`,
+    without creating it: the [`~trainer.BaseTrainer`] creates it when it trains, so that a run restored from the result
+    cache leaves no directory behind.
+    """
+    return os.path.join(root, name + "_" + uuid.uuid4().hex[:8])
+
+
+def remove_empty_dirs(path):
+    """
+    Removes `path` and the directories under it that are left empty.
+    """
+    if not os.path.isdir(path):
+        return
+    for directory, _, _ in sorted(os.walk(path), key=lambda walk: -len(walk[0])):
+        if not os.listdir(directory):
+            os.rmdir(directory)
+
+
+def clean_run_dir(output_dir, logging_dir=None, keep=()):
+    """
+    Deletes what a run wrote to `output_dir` and `logging_dir`, except the `artifacts` in `keep`: `"checkpoints"`
+    keeps the `checkpoint-*` directories, `"logs"` the TensorBoard events.
+    """
+    if "checkpoints" not in keep:
+        # the checkpoints of a trial are in a `run-*` directory of its own
+        for checkpoint in glob.glob(os.path.join(output_dir, "**", PREFIX_CHECKPOINT_DIR + "-*"), recursive=True):
+            shutil.rmtree(checkpoint, ignore_errors=True)
+    if "logs" not in keep and logging_dir is not None:
+        for events in glob.glob(os.path.join(logging_dir, "**", "events.out.tfevents.*"), recursive=True):
+            os.remove(events)
+    if not keep:
+        # the rest is written by the trainer next to the checkpoints, e.g. the final model or the trainer state
+        shutil.rmtree(output_dir, ignore_errors=True)
+    remove_empty_dirs(output_dir)
+    if logging_dir is not None:
+        remove_empty_dirs(logging_dir)
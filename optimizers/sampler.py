@@ -0,0 +1,224 @@
+import torch
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+def dataset_lengths(dataset, length_column_name="length", model_input_name="input_ids"):
+    """
+    The length of every example of `dataset`: its `length_column_name` column if it has one, the lengths of its
+    `model_input_name` otherwise.
+    """
+    column_names = getattr(dataset, "column_names", None) or []
+    if length_column_name in column_names:
+        return list(dataset[length_column_name])
+    if model_input_name in column_names:
+        # a single read of the column instead of one per example
+        return [len(ids) for ids in dataset[model_input_name]]
+    return [len(dataset[i][model_input_name]) for i in range(len(dataset))]
+
+
+def padding_efficiency(lengths, indices, batch_size):
+    """
+    Real tokens over padded tokens of the batches of `batch_size` consecutive `indices`, each padded to its longest
+    example.
+    """
+    real = padded = 0
+    for i in range(0, len(indices), batch_size):
+        batch = [lengths[j] for j in indices[i : i + batch_size]]
+        real += sum(batch)
+        padded += max(batch) * len(batch)
+    return real / padded if padded else 1.0
+
+
+class BucketSampler(torch.utils.data.Sampler):
+    """
+    Samples batches of examples of similar length, so that little of every batch is padding.
+
+    Every epoch, the examples are shuffled and split into mega-batches of `mega_batch_mult` batches, every mega-batch
+    is sorted by length and cut into batches, and the batches of all the mega-batches are shuffled together, so the
+    lengths seen by the model do not follow any order. The whole batch with the longest examples comes first, so that
+    running out of memory happens at the first step, and the only incomplete batch comes last. The order only depends on
+    `generator`, i.e. on the seed it was given.
+
+    The padding efficiency of every epoch (real tokens over padded tokens) is logged, next to the one of random batches.
+    """
+
+    def __init__(self, lengths, batch_size, mega_batch_mult=50, generator=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.mega_batch_mult = max(1, min(mega_batch_mult, len(lengths) // (batch_size * 4)))
+        self.generator = generator
+        self.efficiency = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+        if not indices:
+            return iter(indices)
+        size = self.mega_batch_mult * self.batch_size
+        batches = []
+        for i in range(0, len(indices), size):
+            megabatch = sorted(indices[i : i + size], key=lambda j: self.lengths[j], reverse=True)
+            batches += [megabatch[k : k + self.batch_size] for k in range(0, len(megabatch), self.batch_size)]
+        # only the last batch of the last mega-batch can be incomplete, it stays last so that the others stay whole
+        last = batches.pop() if len(batches[-1]) < self.batch_size else None
+        batches = [batches[k] for k in torch.randperm(len(batches), generator=self.generator).tolist()]
+        if batches:
+            longest = max(range(len(batches)), key=lambda k: self.lengths[batches[k][0]])
+            batches[0], batches[longest] = batches[longest], batches[0]
+        if last is not None:
+            batches.append(last)
+        order = [j for batch in batches for j in batch]
+
+        self.efficiency = padding_efficiency(self.lengths, order, self.batch_size)
+        logger.info(f"Padding efficiency of the length grouped batches: {self.efficiency:.1%} "
+                    f"(random batches: {padding_efficiency(self.lengths, indices, self.batch_size):.1%})")
+        return iter(order)
+
+
+def length_sorted_indices(lengths, batch_size):
+    """
+    The indices of `lengths`, longest first, for evaluation, where the order of the examples does not matter. Logs
+    the padding efficiency it reaches, next to the one of the examples in their order.
+    """
+    order = sorted(range(len(lengths)), key=lambda j: lengths[j], reverse=True)
+    logger.info(f"Padding efficiency of the length sorted evaluation batches: "
+                f"{padding_efficiency(lengths, order, batch_size):.1%} "
+                f"(in order: {padding_efficiency(lengths, list(range(len(lengths))), batch_size):.1%})")
+    return order
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler whose batches hold as many examples as fit in `max_tokens` padded tokens (the length of the longest
+    example of the batch times the number of examples), instead of a fixed number of examples, so that every step
+    costs about the same whatever the lengths of the examples. An example longer than `max_tokens` is a batch of its
+    own.
+
+    Every epoch, the examples are shuffled and split into mega-batches of about `mega_batch_mult` batches, every
+    mega-batch is sorted by length and packed into batches, and the batches of all the mega-batches are shuffled
+    together. The order only depends on `generator`. The batches of the next epoch are planned in advance, so that
+    `len` is the number of batches of the epoch about to be sampled.
+    """
+
+    def __init__(self, lengths, max_tokens, mega_batch_mult=50, generator=None):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        mean_length = sum(lengths) / len(lengths) if lengths else 1
+        self.mega_batch_size = mega_batch_mult * max(1, int(max_tokens // mean_length))
+        self.generator = generator
+        self.efficiency = None
+        self.batches = self.plan()
+
+    def plan(self):
+        indices = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+        batches = []
+        for i in range(0, len(indices), self.mega_batch_size):
+            batch = []
+            # longest first, so the first example of a batch sets its padded length
+            for j in sorted(indices[i : i + self.mega_batch_size], key=lambda j: self.lengths[j], reverse=True):
+                if batch and self.lengths[batch[0]] * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(j)
+            if batch:
+                batches.append(batch)
+        return [batches[k] for k in torch.randperm(len(batches), generator=self.generator).tolist()]
+
+    def mean_batch_size(self):
+        """
+        The mean number of examples per batch of the planned epoch.
+        """
+        return len(self.lengths) / len(self.batches) if self.batches else 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        batches, self.batches = self.batches, self.plan()
+        real = sum(self.lengths[j] for batch in batches for j in batch)
+        padded = sum(self.lengths[batch[0]] * len(batch) for batch in batches)
+        self.efficiency = real / padded if padded else 1.0
+        logger.info(f"Padding efficiency of the token budget batches: {self.efficiency:.1%}, "
+                    f"{len(self.lengths) / max(1, len(batches)):.1f} examples per batch")
+        return iter(batches)
+
+
+def pack_rows(indices, lengths, pack_length):
+    """
+    The examples `indices` packed into rows of at most `pack_length` tokens by best fit decreasing: longest first,
+    every example goes to the fullest row it fits in, or opens a new row. An example longer than `pack_length` is a
+    row of its own. The rows are in the order they were opened and their examples in the order they were added, so
+    that the examples of the rows one after the other fill the same rows again when they are packed in order, each
+    example in the current row if it fits and in a new row otherwise (see [`~packing.PackingCollator`]): the example
+    opening a row did not fit in any row opened before it.
+    """
+    rows = []
+    # free tokens -> the rows with that many free tokens
+    free = [[] for _ in range(pack_length + 1)]
+    for j in sorted(indices, key=lambda j: lengths[j], reverse=True):
+        length = lengths[j]
+        space = next((space for space in range(length, pack_length + 1) if free[space]), None)
+        if space is None:
+            row = []
+            rows.append(row)
+            space = pack_length
+        else:
+            row = free[space].pop()
+        row.append(j)
+        if length <= space:
+            free[space - length].append(row)
+    return rows
+
+
+class PackedBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler of packed batches: `rows` rows of at most `pack_length` tokens, each holding as many examples one
+    after the other as fit in it (see [`~sampler.pack_rows`]), for [`~packing.PackingCollator`], which gets the
+    examples of every batch row by row.
+
+    Every epoch, the examples are shuffled and split into mega-batches of about `mega_batch_mult` batches, the examples
+    of every mega-batch are packed into rows and cut into batches of `rows` rows, and the batches of all the
+    mega-batches are shuffled together. The order only depends on `generator`. The batches of the next epoch are
+    planned in advance, so that `len` is the number of batches of the epoch about to be sampled.
+    """
+
+    def __init__(self, lengths, pack_length, rows, mega_batch_mult=50, generator=None):
+        self.lengths = lengths
+        self.pack_length = pack_length
+        self.rows = rows
+        mean_length = sum(lengths) / len(lengths) if lengths else 1
+        self.mega_batch_size = mega_batch_mult * rows * max(1, int(pack_length // mean_length))
+        self.generator = generator
+        self.efficiency = None
+        self.batches = self.plan()
+
+    def plan(self):
+        indices = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+        batches = []
+        for i in range(0, len(indices), self.mega_batch_size):
+            rows = pack_rows(indices[i : i + self.mega_batch_size], self.lengths, self.pack_length)
+            batches += [rows[k : k + self.rows] for k in range(0, len(rows), self.rows)]
+        return [batches[k] for k in torch.randperm(len(batches), generator=self.generator).tolist()]
+
+    def mean_batch_size(self):
+        """
+        The mean number of examples per batch of the planned epoch.
+        """
+        return len(self.lengths) / len(self.batches) if self.batches else 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        batches, self.batches = self.batches, self.plan()
+        real = sum(self.lengths[j] for batch in batches for row in batch for j in row)
+        # every batch is padded to its longest row
+        padded = sum(len(batch) * max(sum(self.lengths[j] for j in row) for row in batch) for batch in batches)
+        self.efficiency = real / padded if padded else 1.0
+        logger.info(f"Padding efficiency of the packed batches: {self.efficiency:.1%}, "
+                    f"{len(self.lengths) / max(1, len(batches)):.1f} examples per batch")
+        return iter([j for row in batch for j in row] for batch in batches)
@@ -0,0 +1,63 @@
+import math
+
+# samplers of `make_sampler`: plain TPE, or TPE that imputes the trials still running with the worst value seen so far
+samplers = ["tpe", "liar"]
+
+
+def make_sampler(name, seed=None):
+    """
+    Returns the optuna sampler `name` of `samplers`.
+
+    `"liar"` is TPE with constant liar imputation: the trials still running count as the worst trial so far, so a
+    trial started while others run (by trial workers, see [`~workers.run_workers`], or when the members of population
+    based training are asked at once) is sampled away from them instead of next to them. Trials started one after
+    the other are sampled as with `"tpe"`.
+    """
+    import optuna
+
+    if name not in samplers:
+        raise ValueError(f"sampler must be one of {samplers}, got {name}.")
+    return optuna.samplers.TPESampler(seed=seed, constant_liar=name == "liar")
+
+
+def distance(distribution, value, other):
+    """
+    Distance between two values of a hyperparameter, as a fraction of the range of `distribution` (in log scale for
+    log distributions), infinite between different categories.
+    """
+    import optuna
+
+    if isinstance(distribution, optuna.distributions.CategoricalDistribution):
+        return 0.0 if value == other else math.inf
+    low, high = distribution.low, distribution.high
+    if distribution.log:
+        value, other, low, high = math.log(value), math.log(other), math.log(low), math.log(high)
+    return abs(value - other) / (high - low) if high > low else 0.0
+
+
+def find_duplicate(trial, tolerance):
+    """
+    Returns the first trial of the study of `trial` started before it, running or finished but not failed, whose
+    hyperparameters are all within `tolerance` of the ones of `trial` (see `distance`), or `None`.
+    """
+    import optuna
+
+    states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED, optuna.trial.TrialState.RUNNING)
+    for other in trial.study.get_trials(deepcopy=False, states=states):
+        if other.number >= trial.number or other.params.keys() != trial.params.keys():
+            continue
+        if all(distance(trial.distributions[name], value, other.params[name]) <= tolerance
+               for name, value in trial.params.items()):
+            return other
+    return None
+
+
+def known_value(trial):
+    """
+    The value of a finished single objective trial, or the last one a running trial reported, or `None`.
+    """
+    if trial.values is not None:
+        return trial.values[0] if len(trial.values) == 1 else None
+    if trial.last_step is not None:
+        return trial.intermediate_values[trial.last_step]
+    return None
@@ -0,0 +1,111 @@
+import os
+
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+
+def default_procs():
+    # the CPUs this process may run on, e.g. the ones a sweep pinned its job to
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def parallel_map(dataset, function, num_proc=None, batch_size=1000, cache_file_name=None):
+    """
+    `dataset.map(function, batched=True, batch_size=batch_size)` split across `num_proc` processes (by default one per
+    CPU available, at most one per batch), each mapping a contiguous shard of the dataset and writing it to its own
+    part of `cache_file_name` (the cache of `datasets` by default).
+
+    The processes are the parallelism: they run with `TOKENIZERS_PARALLELISM=false`, so that the threads of the Rust
+    tokenizers of every process do not oversubscribe the CPUs. In a single process, the Rust tokenizer parallelizes
+    every batch itself, as `TOKENIZERS_PARALLELISM` allows.
+    """
+    num_proc = max(1, min(num_proc or default_procs(), len(dataset) // batch_size))
+    if num_proc == 1:
+        return dataset.map(function, batched=True, batch_size=batch_size, cache_file_name=cache_file_name)
+    parallelism = os.environ.get("TOKENIZERS_PARALLELISM")
+    # inherited by the processes the map forks
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    try:
+        return dataset.map(function, batched=True, batch_size=batch_size, num_proc=num_proc,
+                           cache_file_name=cache_file_name)
+    finally:
+        if parallelism is None:
+            del os.environ["TOKENIZERS_PARALLELISM"]
+        else:
+            os.environ["TOKENIZERS_PARALLELISM"] = parallelism
+
+
+class PairEncoder:
+    """
+    `tokenizer(first, second, truncation=truncation, max_length=max_length)` of sentence pairs, that tokenizes every
+    distinct sentence once: in MNLI every premise comes with about three hypotheses, and MRPC and STS-B repeat
+    sentences too. The token ids of every sentence seen are kept (by every call, e.g. every batch of `datasets.map`),
+    and the pairs are assembled from them with the special tokens and token type ids of the tokenizer itself
+    (`build_inputs_with_special_tokens` and `create_token_type_ids_from_sequences`).
+
+    The encodings are the ones of the tokenizer: the pairs that need truncating are encoded by the tokenizer, and every
+    call checks its first pair against the tokenizer, falling back to the tokenizer for good if they differ. Without
+    `second`, the sentences are encoded by the tokenizer.
+    """
+
+    def __init__(self, tokenizer, truncation=True, max_length=None):
+        self.tokenizer = tokenizer
+        self.truncation = truncation
+        self.max_length = max_length
+        self.ids = {}
+        self.exact = True
+
+    def __getstate__(self):
+        # without the ids of the sentences seen, so that hashing (`datasets.map` fingerprints the function) and sending
+        # the encoder to other processes do not depend on them
+        return dict(self.__dict__, ids={})
+
+    def encode(self, first, second=None):
+        # the tokenizer itself
+        return dict(self.tokenizer(first, second, truncation=self.truncation, max_length=self.max_length))
+
+    def __call__(self, first, second=None):
+        if second is None or not self.exact or not first:
+            return self.encode(first, second)
+        sentences = list(dict.fromkeys(s for s in list(first) + list(second) if s not in self.ids))
+        if sentences:
+            tokenized = self.tokenizer(sentences, add_special_tokens=False, verbose=False)["input_ids"]
+            self.ids.update(zip(sentences, tokenized))
+
+        tokenizer = self.tokenizer
+        max_length = self.max_length if self.max_length is not None else tokenizer.model_max_length
+        specials = tokenizer.num_special_tokens_to_add(pair=True)
+        token_type_ids = "token_type_ids" in tokenizer.model_input_names
+        attention_mask = "attention_mask" in tokenizer.model_input_names
+        encodings = {"input_ids": []}
+        if token_type_ids:
+            encodings["token_type_ids"] = []
+        if attention_mask:
+            encodings["attention_mask"] = []
+        truncated = []
+        for i, (a, b) in enumerate(zip(first, second)):
+            a, b = self.ids[a], self.ids[b]
+            if self.truncation and len(a) + len(b) + specials > max_length:
+                truncated.append(i)
+                a, b = [], []
+            input_ids = tokenizer.build_inputs_with_special_tokens(a, b)
+            encodings["input_ids"].append(input_ids)
+            if token_type_ids:
+                encodings["token_type_ids"].append(tokenizer.create_token_type_ids_from_sequences(a, b))
+            if attention_mask:
+                encodings["attention_mask"].append([1] * len(input_ids))
+        if truncated:
+            encoded = self.encode([first[i] for i in truncated], [second[i] for i in truncated])
+            for key, values in encodings.items():
+                for i, value in zip(truncated, encoded[key]):
+                    values[i] = value
+
+        reference = self.encode(first[:1], second[:1])
+        if reference.keys() != encodings.keys() or any(reference[key][0] != encodings[key][0] for key in reference):
+            logger.warning(f"The pairs assembled from the sentences differ from the ones of {type(tokenizer).__name__}, "
+                           f"the pairs are encoded by the tokenizer.")
+            self.exact = False
+            self.ids = {}
+            return self.encode(first, second)
+        return encodings
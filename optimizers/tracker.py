@@ -0,0 +1,49 @@
+import math
+import threading
+
+
+class MetricTracker:
+    """
+    Keeps the metric curve of every trial of a hyperparameter search, and the best objective each trial reached so
+    far, which is what the trial reports to its study (a trial is as good as its best evaluation, as with
+    `load_best_model_at_end`).
+
+    Trials are told apart by their study and number, not by their hyperparameters, so two trials that sample the same
+    values never share a curve. Recording is guarded by a lock, so trials may run in parallel threads, and the curve of
+    an optuna trial is also stored in its `curve` user attribute, so it ends up in the storage of the study and
+    trials run in other processes against the same storage are kept apart as well.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.curves = {}
+        self.best = {}
+
+    @staticmethod
+    def key(trial):
+        if trial is None or isinstance(trial, dict):
+            return None
+        return trial.study.study_name, trial.number
+
+    def record(self, trial, step, metrics, objective, greater_is_better=True):
+        """
+        Adds an evaluation of `trial` at `step` and returns the best objective of the trial so far. Objectives that are
+        not finite (e.g. the Pearson correlation of constant predictions, or a diverged loss) are kept in the curve but
+        never become the best one, they are returned only until the trial has a finite one.
+        """
+        key = self.key(trial)
+        with self.lock:
+            curve = self.curves.setdefault(key, [])
+            curve.append(dict(metrics, step=step, objective=objective))
+            best = self.best.get(key)
+            better = best is None or (objective > best if greater_is_better else objective < best)
+            if math.isfinite(objective) and better:
+                self.best[key] = best = objective
+            curve = list(curve)
+        if key is not None:
+            trial.set_user_attr("curve", curve)
+        return objective if best is None else best
+
+    def curve(self, trial):
+        with self.lock:
+            return list(self.curves.get(self.key(trial), []))
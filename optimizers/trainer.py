@@ -0,0 +1,584 @@
+import copy
+import os
+
+import datasets
+import torch
+from torch.utils.data import DataLoader
+from transformers import Trainer
+from transformers.trainer_utils import BestRun, HPSearchBackend, default_compute_objective, set_seed
+from transformers.utils import logging
+
+from .batch_size import best_batch_size, lr_scaling_rules, probe_batch_sizes
+from .callbacks import DivergenceCallback, TimeToTargetCallback
+from .packing import PackingCollator, packed_forward, packed_model_types
+from .pbt import PopulationBasedTraining, member_args
+from .run_dir import clean_run_dir, remove_empty_dirs
+from .sampler import (BucketSampler, PackedBatchSampler, TokenBudgetBatchSampler, dataset_lengths,
+                      length_sorted_indices)
+from .sampling import find_duplicate, known_value
+from .tracker import MetricTracker
+from .workers import run_workers
+
+logger = logging.get_logger(__name__)
+
+
+class BaseTrainer(Trainer):
+    """
+    The part of `MyTrainer` that is the same for every optimizer.
+
+    The evaluations of the trials of a hyperparameter search are recorded by `metric_tracker` (see [`MetricTracker`]),
+    and every trial reports the best objective it reached so far, so `compute_metrics` only has to compute the metrics
+    of a single evaluation and must not keep state between calls.
+
+    Every trial writes to its own `trial-<number>` directory under `output_dir` (and `logging_dir`), so trials never
+    share checkpoints or logs.
+
+    Args:
+        keep_artifacts (`List[str]`, *optional*):
+            If set, what every training wrote is deleted when it ends, finished or pruned, except the
+            [`~run_dir.artifacts`] listed here (e.g. `[]` to delete everything, `["logs"]` to keep only the
+            TensorBoard events). By default everything is kept.
+
+    With `group_by_length` in `args`, the training batches are made of examples of similar length by a
+    [`~sampler.BucketSampler`], whose padding efficiency is added to the training logs, and the evaluation batches of
+    `evaluate` are sorted by length, see [`~sampler.length_sorted_indices`] (the batches of `predict` stay in the order
+    of the dataset).
+
+    With [`~BaseTrainer.use_token_budget`], the training batches are instead made of as many examples as fit in a
+    number of padded tokens, see [`~sampler.TokenBudgetBatchSampler`], and with [`~BaseTrainer.use_packing`] they are
+    rows of several examples packed one after the other, see [`~packing.PackingCollator`].
+
+    The learning rates set in `args`, sampled by a hyperparameter search or set by population based training are the
+    ones of the batch size in `args`, they are multiplied by `lr_scale` when the batch size is changed by
+    [`~BaseTrainer.find_batch_sizes`], [`~BaseTrainer.use_token_budget`] or [`~BaseTrainer.use_packing`].
+    """
+
+    def __init__(self, *args, keep_artifacts=None, **kwargs):
+        training_args = kwargs.get("args", args[1] if len(args) > 1 else None)
+        new_dir = training_args is not None and not os.path.exists(training_args.output_dir)
+        super().__init__(*args, **kwargs)
+        if new_dir:
+            # created by `Trainer` and again by the first save, a trainer that never trains leaves nothing behind
+            remove_empty_dirs(self.args.output_dir)
+        self.metric_tracker = MetricTracker()
+        self.keep_artifacts = keep_artifacts
+        self.run_dir = self.args.output_dir
+        self.run_logging_dir = self.args.logging_dir
+        self.lr_scale = 1.0
+        self.deduplicate = 0.0
+        self.lengths = {}
+        self.sort_eval = False
+        self.bucket_sampler = None
+        self.max_tokens = None
+        self.pack_length = None
+        self.mean_batch_size = None
+
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            if self.keep_artifacts is not None:
+                clean_run_dir(self.args.output_dir, self.args.logging_dir, keep=self.keep_artifacts)
+
+    def dataset_lengths(self, dataset):
+        # computed once per dataset, the datasets are kept with them so that their ids are not reused
+        key = getattr(dataset, "_fingerprint", None) or id(dataset)
+        if key not in self.lengths:
+            model_input_name = self.tokenizer.model_input_names[0] if self.tokenizer is not None else "input_ids"
+            self.lengths[key] = (dataset, dataset_lengths(dataset, self.args.length_column_name, model_input_name))
+        return self.lengths[key][1]
+
+    def _get_train_sampler(self):
+        if not self.args.group_by_length or self.args.world_size > 1 or self.train_dataset is None:
+            return super()._get_train_sampler()
+        generator = torch.Generator()
+        generator.manual_seed(self.args.data_seed if self.args.data_seed is not None else self.args.seed)
+        self.bucket_sampler = BucketSampler(self.dataset_lengths(self.train_dataset),
+                                            self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                                            generator=generator)
+        return self.bucket_sampler
+
+    def token_budget_sampler(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.args.data_seed if self.args.data_seed is not None else self.args.seed)
+        return TokenBudgetBatchSampler(self.dataset_lengths(self.train_dataset), self.max_tokens, generator=generator)
+
+    def packed_sampler(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.args.data_seed if self.args.data_seed is not None else self.args.seed)
+        return PackedBatchSampler(self.dataset_lengths(self.train_dataset), self.pack_length,
+                                  self.args.per_device_train_batch_size, generator=generator)
+
+    def get_train_dataloader(self):
+        planned = self.max_tokens is not None or self.pack_length is not None
+        if not planned or self.args.world_size > 1 or self.train_dataset is None:
+            return super().get_train_dataloader()
+        train_dataset = self.train_dataset
+        data_collator = self.data_collator
+        if self.pack_length is not None:
+            pad_token_id = self.tokenizer.pad_token_id if self.tokenizer is not None else 0
+            data_collator = PackingCollator(self.pack_length, pad_token_id)
+        if isinstance(train_dataset, datasets.Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+        else:
+            data_collator = self._get_collator_with_removed_columns(data_collator, description="training")
+        self.bucket_sampler = self.packed_sampler() if self.pack_length is not None else self.token_budget_sampler()
+        self.mean_batch_size = self.bucket_sampler.mean_batch_size()
+        return DataLoader(
+            train_dataset,
+            batch_sampler=self.bucket_sampler,
+            collate_fn=data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        if "segment_ids" in inputs:
+            # a packed batch, every example is classified on its own
+            outputs = packed_forward(model, inputs)
+            loss = outputs.loss
+            batch_size = len(inputs["labels"])
+        elif self.max_tokens is None or not model.training or self.mean_batch_size is None:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs)
+        else:
+            batch_size = len(next(iter(inputs.values())))
+            loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
+        # the loss is the mean over the batch, weighted by the size of the batch it is the mean over every example
+        # of the epoch, whatever the batch it is in
+        loss = loss * (batch_size / self.mean_batch_size)
+        return (loss, outputs) if return_outputs else loss
+
+    def log(self, logs):
+        # the training logs report the padding efficiency of the length grouped batches of the epoch
+        if "loss" in logs and self.bucket_sampler is not None and self.bucket_sampler.efficiency is not None:
+            logs["padding_efficiency"] = round(self.bucket_sampler.efficiency, 4)
+        super().log(logs)
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        self.sort_eval = self.args.group_by_length and self.args.world_size <= 1
+        try:
+            return super().get_eval_dataloader(eval_dataset)
+        finally:
+            self.sort_eval = False
+
+    def _get_eval_sampler(self, eval_dataset):
+        if not self.sort_eval:
+            return super()._get_eval_sampler(eval_dataset)
+        return length_sorted_indices(self.dataset_lengths(eval_dataset), self.args.eval_batch_size)
+
+    def _hp_search_setup(self, trial):
+        super()._hp_search_setup(trial)
+        if self.hp_search_backend != HPSearchBackend.OPTUNA or trial is None:
+            return
+        if "learning_rate" in trial.params:
+            self.args.learning_rate = trial.params["learning_rate"] * self.lr_scale
+        if self.deduplicate:
+            self._skip_duplicate(trial)
+        self.args.output_dir = os.path.join(self.run_dir, "trial-" + str(trial.number))
+        if self.run_logging_dir is not None:
+            self.args.logging_dir = os.path.join(self.run_logging_dir, "trial-" + str(trial.number))
+
+    def find_batch_sizes(self, max_batch_size=256, memory_limit=None, lr_scaling="none", steps=3):
+        """
+        Pre-flight run that probes the batch sizes from the one in `args` up to `max_batch_size`, doubling it every time,
+        on a copy of the model (see [`~batch_size.probe_batch_sizes`]), separately for training (forward, backward and
+        optimizer step) and evaluation (forward only), and sets `per_device_train_batch_size` and
+        `per_device_eval_batch_size` to the ones with the highest throughput that fit in memory. The batches are made
+        of the longest examples, so that a batch size that fits does so for every batch.
+
+        The learning rate is multiplied by `lr_scaling_rules[lr_scaling]` of the ratio of the new training batch size to
+        the old one (`"none"`, `"linear"` or `"sqrt"`), and the evaluation, logging, saving and warmup steps are divided
+        by it, so that they happen after the same number of samples as before.
+
+        Args:
+            max_batch_size (`int`, *optional*, defaults to 256): The largest batch size probed.
+            memory_limit (`int`, *optional*): Peak memory in bytes a batch size must stay below to fit (on CPU, what
+                its steps add to the memory of the process, see [`~batch_size.PeakMemory`]), by default only the
+                ones that run out of memory do not fit.
+            lr_scaling (`str`, *optional*, defaults to `"none"`): How the learning rate follows the batch size.
+            steps (`int`, *optional*, defaults to 3): Number of steps timed per batch size.
+
+        Returns:
+            `Dict[str, List[Dict]]`: The `"train"` and `"eval"` results of every batch size probed.
+        """
+        if lr_scaling not in lr_scaling_rules:
+            raise ValueError(f"lr_scaling must be one of {list(lr_scaling_rules)}, got {lr_scaling}.")
+        # the probes (the model initialization, dropout) must not change the random state the trials start from
+        with torch.random.fork_rng():
+            results = self._probe_batch_sizes(max_batch_size, memory_limit, steps)
+
+        train_batch_size = best_batch_size(results["train"])
+        scale = self._scale_batch_size(train_batch_size / self.args.per_device_train_batch_size, lr_scaling)
+        self.args.per_device_train_batch_size = train_batch_size
+        self.args.per_device_eval_batch_size = best_batch_size(results["eval"])
+        logger.info(f"Batch sizes: {self.args.per_device_train_batch_size} for training, "
+                    f"{self.args.per_device_eval_batch_size} for evaluation, learning rate scaled by {scale:g} "
+                    f"({lr_scaling})")
+        return results
+
+    def use_token_budget(self, max_tokens, lr_scaling="none"):
+        """
+        Makes the training batches of as many examples as fit in `max_tokens` padded tokens (see
+        [`~sampler.TokenBudgetBatchSampler`]) instead of `per_device_train_batch_size` examples, so that batches of
+        short examples hold more of them and batches of long ones fewer, for about the same cost per step.
+
+        Every batch is weighted by its number of examples over the mean one in the loss, so every example weighs the
+        same whatever the batch it is in, and the learning rate, evaluation, logging, saving and warmup steps follow
+        the ratio of the mean batch size to `per_device_train_batch_size` as in [`~BaseTrainer.find_batch_sizes`].
+        The number of training steps is the one of the first epoch times the number of epochs, the batches of later
+        epochs are packed from other examples and can be a few more or less.
+
+        Args:
+            max_tokens (`int`): The number of padded tokens of a batch (per device and accumulation step).
+            lr_scaling (`str`, *optional*, defaults to `"none"`): How the learning rate follows the batch size.
+
+        Returns:
+            `float`: The mean number of examples per batch.
+        """
+        if lr_scaling not in lr_scaling_rules:
+            raise ValueError(f"lr_scaling must be one of {list(lr_scaling_rules)}, got {lr_scaling}.")
+        self.max_tokens = max_tokens
+        mean_batch_size = self.token_budget_sampler().mean_batch_size()
+        scale = self._scale_batch_size(mean_batch_size / self.args.per_device_train_batch_size, lr_scaling)
+        logger.info(f"Batches of {max_tokens} tokens: {mean_batch_size:.1f} examples on average, learning rate scaled "
+                    f"by {scale:g} ({lr_scaling})")
+        return mean_batch_size
+
+    def use_packing(self, pack_length, lr_scaling="none"):
+        """
+        Makes the training batches of `per_device_train_batch_size` rows of at most `pack_length` tokens, each holding
+        as many examples one after the other as fit in it (see [`~sampler.PackedBatchSampler`]), instead of
+        `per_device_train_batch_size` examples, so that a batch of short sentences holds several times more of them
+        for about the same cost. Every example attends to its own tokens only, starts over at position 0 and is
+        classified from its own first token, as in a row of its own (see [`~packing.packed_forward`]). Evaluation and
+        prediction batches are not packed.
+
+        The loss and the learning rate, evaluation, logging, saving and warmup steps follow the mean number of examples
+        per batch as in [`~BaseTrainer.use_token_budget`].
+
+        Args:
+            pack_length (`int`): The number of tokens of a row, at most the maximum length of the model.
+            lr_scaling (`str`, *optional*, defaults to `"none"`): How the learning rate follows the batch size.
+
+        Returns:
+            `float`: The mean number of examples per batch.
+        """
+        if lr_scaling not in lr_scaling_rules:
+            raise ValueError(f"lr_scaling must be one of {list(lr_scaling_rules)}, got {lr_scaling}.")
+        if self.model.config.model_type not in packed_model_types:
+            raise ValueError(f"Packed batches are not supported for {self.model.config.model_type} models, only "
+                             f"{packed_model_types}.")
+        if self.max_tokens is not None:
+            raise ValueError("Packed batches and token budget batches cannot be used together.")
+        self.pack_length = pack_length
+        mean_batch_size = self.packed_sampler().mean_batch_size()
+        scale = self._scale_batch_size(mean_batch_size / self.args.per_device_train_batch_size, lr_scaling)
+        logger.info(f"Batches of {self.args.per_device_train_batch_size} rows of {pack_length} tokens: "
+                    f"{mean_batch_size:.1f} examples on average, learning rate scaled by {scale:g} ({lr_scaling})")
+        return mean_batch_size
+
+    def _scale_batch_size(self, ratio, lr_scaling):
+        # the learning rate and the steps counted in batches follow a training batch size `ratio` times the old one
+        scale = lr_scaling_rules[lr_scaling](ratio)
+        self.args.learning_rate *= scale
+        self.lr_scale *= scale
+        for name in ("eval_steps", "logging_steps", "save_steps", "warmup_steps"):
+            if getattr(self.args, name):
+                setattr(self.args, name, max(1, round(getattr(self.args, name) / ratio)))
+        return scale
+
+    def _probe_batch_sizes(self, max_batch_size, memory_limit, steps):
+        model = self.call_model_init() if self.model_init is not None else copy.deepcopy(self.model)
+        model = model.to(self.args.device)
+        optimizer_cls, optimizer_kwargs = self.get_optimizer_cls_and_kwargs(self.args)
+        optimizer = optimizer_cls(model.parameters(), **optimizer_kwargs)
+
+        def batches(dataset, description):
+            lengths = self.dataset_lengths(dataset)
+            rows = sorted(range(len(dataset)), key=lambda row: -lengths[row])
+            data_collator = self.data_collator
+            if isinstance(dataset, datasets.Dataset):
+                dataset = self._remove_unused_columns(dataset, description=description)
+            else:
+                data_collator = self._get_collator_with_removed_columns(data_collator, description=description)
+
+            def batch(batch_size):
+                examples = [dataset[rows[i % len(rows)]] for i in range(batch_size)]
+                return self._prepare_inputs(data_collator(examples))
+
+            return batch
+
+        train_batch = batches(self.train_dataset, "training")
+        eval_batch = batches(self.eval_dataset if self.eval_dataset is not None else self.train_dataset, "evaluation")
+
+        def train_step(batch_size):
+            model.train()
+            loss = self.compute_loss(model, train_batch(batch_size))
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        def eval_step(batch_size):
+            model.eval()
+            with torch.no_grad():
+                model(**eval_batch(batch_size))
+
+        def candidates(batch_size):
+            sizes = [batch_size]
+            while sizes[-1] * 2 <= max_batch_size:
+                sizes.append(sizes[-1] * 2)
+            return sizes
+
+        device = self.args.device
+        return {
+            "train": probe_batch_sizes(train_step, candidates(self.args.per_device_train_batch_size), device, steps,
+                                       memory_limit),
+            "eval": probe_batch_sizes(eval_step, candidates(self.args.per_device_eval_batch_size), device, steps,
+                                      memory_limit),
+        }
+
+    def _skip_duplicate(self, trial):
+        import optuna
+
+        duplicate = find_duplicate(trial, self.deduplicate)
+        if duplicate is None:
+            return
+        trial.set_user_attr("duplicate_of", duplicate.number)
+        value = known_value(duplicate)
+        if value is not None and len(trial.study.directions) == 1:
+            # the pruned trial keeps the value of the one it duplicates, so the sampler does not take it for a bad one
+            trial.report(value, 0)
+        raise optuna.TrialPruned(f"Trial {trial.number} duplicates trial {duplicate.number}.")
+
+    def hyperparameter_search(self, hp_space=None, compute_objective=None, n_trials=20, direction="minimize",
+                              backend=None, hp_name=None, target=None, population=None, workers=1, deduplicate=0.0,
+                              **kwargs):
+        """
+        Same as [`Trainer.hyperparameter_search`], with an extra multi-objective mode, population based training and
+        trials run in parallel processes.
+
+        Args:
+            target (`float`, *optional*):
+                If set, every trial is stopped as soon as its objective reaches `target`, and the search optimizes both
+                the objective (in `direction`) and the wall-clock time needed to reach `target` (or to train to the
+                end when it is never reached). The optuna backend is used, and the Pareto front is returned as a list
+                of [`~trainer_utils.BestRun`], the trials that reached `target` first, fastest first, whose objective
+                also holds the time and steps to target. A trial that ends without any evaluation is pruned.
+            population (`int`, *optional*):
+                If set, instead of `n_trials` independent trials, a population of that many models is trained at the
+                same time with [`~pbt.PopulationBasedTraining`], starting from hyperparameters sampled from `hp_space`
+                by the optuna study.
+            workers (`int`, *optional*, defaults to 1):
+                If more than 1, the trials are run by that many worker processes forked from this one, see
+                [`~workers.run_workers`]. The optuna backend is used, and the study must be kept in a database given
+                as `storage`.
+            deduplicate (`float`, *optional*, defaults to 0.0):
+                If set, an optuna trial whose hyperparameters are all within this fraction of their range of the ones
+                of an earlier trial, running or finished, is pruned before it trains (see
+                [`~sampling.find_duplicate`]), with the value of the earlier trial. Pass a sampler that knows about
+                the running trials, e.g. `sampler=make_sampler("liar")`, to get fewer duplicates in the first place.
+        """
+        if target is not None and population:
+            raise ValueError("Population based training can not be combined with a target.")
+        if workers > 1 and (target is not None or population):
+            raise ValueError("Trial workers can not be combined with a target or population based training.")
+        self.deduplicate = deduplicate
+        try:
+            if workers > 1:
+                return self.forked_search(workers, hp_space=hp_space, compute_objective=compute_objective,
+                                          n_trials=n_trials, direction=direction, hp_name=hp_name, **kwargs)
+            return self._hyperparameter_search(hp_space=hp_space, compute_objective=compute_objective,
+                                               n_trials=n_trials, direction=direction, backend=backend,
+                                               hp_name=hp_name, target=target, population=population, **kwargs)
+        finally:
+            self.args.output_dir = self.run_dir
+            self.args.logging_dir = self.run_logging_dir
+            if self.keep_artifacts is not None:
+                remove_empty_dirs(self.run_dir)
+                if self.run_logging_dir is not None:
+                    remove_empty_dirs(self.run_logging_dir)
+
+    def _hyperparameter_search(self, hp_space, compute_objective, n_trials, direction, backend, hp_name, target,
+                               population, **kwargs):
+        if population:
+            return self.population_based_training(population, hp_space=hp_space, compute_objective=compute_objective,
+                                                  direction=direction, **kwargs)
+        if target is None:
+            return super().hyperparameter_search(hp_space=hp_space, compute_objective=compute_objective,
+                                                 n_trials=n_trials, direction=direction, backend=backend,
+                                                 hp_name=hp_name, **kwargs)
+        import optuna
+
+        if self.model_init is None:
+            raise RuntimeError(
+                "To use hyperparameter search, you need to pass your model through a model_init function."
+            )
+        self.hp_search_backend = HPSearchBackend.OPTUNA
+        self.hp_space = hp_space
+        self.hp_name = hp_name
+        self.compute_objective = default_compute_objective if compute_objective is None else compute_objective
+
+        callback = TimeToTargetCallback(target, self.compute_objective, greater_is_better=direction == "maximize")
+
+        def _objective(trial):
+            self.objective = None
+            self.train(trial=trial)
+            trial.set_user_attr("reached_target", callback.reached_target)
+            trial.set_user_attr("seconds_to_target", callback.seconds)
+            trial.set_user_attr("steps_to_target", callback.steps)
+            if callback.best is None:
+                # no evaluation ran, e.g. a diverged run, the trial has no objective
+                raise optuna.TrialPruned(f"Trial {trial.number} ended without an evaluation.")
+            return callback.best, callback.seconds
+
+        timeout = kwargs.pop("timeout", None)
+        n_jobs = kwargs.pop("n_jobs", 1)
+        study = optuna.create_study(directions=[direction, "minimize"], **kwargs)
+        self.add_callback(callback)
+        try:
+            study.optimize(_objective, n_trials=n_trials, timeout=timeout, n_jobs=n_jobs)
+        finally:
+            # a search that is stopped leaves the trainer as it was
+            self.remove_callback(callback)
+            self.hp_search_backend = None
+
+        return [
+            BestRun(
+                str(trial.number),
+                {
+                    "objective": trial.values[0],
+                    "reached_target": trial.user_attrs["reached_target"],
+                    "seconds_to_target": trial.user_attrs["seconds_to_target"],
+                    "steps_to_target": trial.user_attrs["steps_to_target"],
+                },
+                trial.params,
+            )
+            # the time of a trial that missed the target is the one of its whole training, it comes after the others
+            for trial in sorted(study.best_trials,
+                                key=lambda t: (not t.user_attrs["reached_target"], t.values[1]))
+        ]
+
+    def forked_search(self, workers, hp_space, compute_objective=None, n_trials=20, direction="minimize",
+                      hp_name=None, storage=None, **kwargs):
+        """
+        Runs the trials of an optuna search in `workers` processes forked from this one, with
+        [`~workers.run_workers`], and returns the best one as a [`~trainer_utils.BestRun`]. `storage` is the URL of
+        the database the study is kept in, `kwargs` are passed to `optuna.create_study`.
+        """
+        import optuna
+
+        if self.model_init is None:
+            raise RuntimeError(
+                "To use hyperparameter search, you need to pass your model through a model_init function."
+            )
+        if isinstance(storage, optuna.storages.RDBStorage):
+            storage = storage.url
+        if not isinstance(storage, str):
+            raise ValueError("Trial workers share the study through a database, pass its URL as storage, e.g. "
+                             "sqlite:///studies.db.")
+        self.hp_search_backend = HPSearchBackend.OPTUNA
+        self.hp_space = hp_space
+        self.hp_name = hp_name
+        self.compute_objective = default_compute_objective if compute_objective is None else compute_objective
+
+        def _objective(trial):
+            self.objective = None
+            self.train(trial=trial)
+            # if there was no evaluation during the training
+            if self.objective is None:
+                self.objective = self.compute_objective(self.evaluate())
+            return self.objective
+
+        timeout = kwargs.pop("timeout", None)
+        kwargs.pop("n_jobs", None)
+        study = optuna.create_study(direction=direction, storage=storage, **kwargs)
+        # loaded once here, so that the workers share the pretrained weights (see `cached_from_pretrained`)
+        with torch.random.fork_rng():
+            self.call_model_init()
+        run_workers(study, storage, _objective, n_trials, workers, timeout=timeout, sampler=kwargs.get("sampler"))
+        self.hp_search_backend = None
+
+        best_trial = optuna.load_study(study_name=study.study_name, storage=storage).best_trial
+        return BestRun(str(best_trial.number), best_trial.value, best_trial.params)
+
+    def population_based_training(self, population, hp_space, compute_objective=None, direction="minimize",
+                                  **kwargs):
+        """
+        Trains a population of `population` models with [`~pbt.PopulationBasedTraining`]. The initial hyperparameters
+        of the members are asked from an optuna study created with `direction` and `kwargs`, and every trial of the
+        study is then told the best objective reached by its member. Returns the best member as a
+        [`~trainer_utils.BestRun`] with the hyperparameters it reached its best objective with.
+        """
+        import optuna
+
+        if self.model_init is None:
+            raise RuntimeError("To use population based training, you need to pass your model through a model_init "
+                               "function.")
+        compute_objective = default_compute_objective if compute_objective is None else compute_objective
+        kwargs.pop("timeout", None)
+        kwargs.pop("n_jobs", None)
+        study = optuna.create_study(direction=direction, **kwargs)
+        trials = [study.ask() for _ in range(population)]
+        params = [hp_space(trial) for trial in trials]
+        trainers = []
+        for i in range(population):
+            args = member_args(self.args, i, params[i], lr_scale=self.lr_scale)
+            # the models are built here one after another, every one from the seed of its member: with `model_init`,
+            # the threads of the members would seed and draw from the global generators at the same time
+            set_seed(args.seed)
+            trainers.append(type(self)(
+                model=self.call_model_init(),
+                args=args,
+                data_collator=self.data_collator,
+                train_dataset=self.train_dataset,
+                eval_dataset=self.eval_dataset,
+                tokenizer=self.tokenizer,
+                compute_metrics=self.compute_metrics,
+                # the callbacks added on top of the ones of transformers, every member gets its own
+                callbacks=[copy.deepcopy(c) for c in self.callback_handler.callbacks
+                           if not type(c).__module__.startswith("transformers.")],
+                keep_artifacts=self.keep_artifacts,
+            ))
+        for trainer in trainers:
+            # the learning rates of `params` are scaled by `lr_scale` already
+            trainer.max_tokens = self.max_tokens
+            trainer.pack_length = self.pack_length
+        pbt = PopulationBasedTraining(trainers, params, trials[0].distributions, compute_objective,
+                                      direction=direction, seed=self.args.seed, lr_scale=self.lr_scale)
+        best = pbt.train()
+        for trial, (objective, _) in zip(trials, best):
+            if objective is None:
+                # the member diverged before its first finite evaluation
+                study.tell(trial, state=optuna.trial.TrialState.PRUNED)
+            else:
+                study.tell(trial, objective)
+
+        members = [i for i in range(population) if best[i][0] is not None]
+        if not members:
+            raise RuntimeError("Every member of the population diverged.")
+        index = max(members, key=lambda i: best[i][0] if direction == "maximize" else -best[i][0])
+        return BestRun("member-" + str(index), best[index][0], best[index][1])
+
+    def training_step(self, model, inputs):
+        loss = super().training_step(model, inputs)
+        for callback in self.callback_handler.callbacks:
+            if isinstance(callback, DivergenceCallback):
+                callback.update(loss, model)
+        return loss
+
+    def _report_to_hp_search(self, trial, step, metrics):
+        if self.hp_search_backend != HPSearchBackend.OPTUNA or trial is None:
+            return super()._report_to_hp_search(trial, step, metrics)
+        import optuna
+
+        directions = trial.study.directions
+        maximize = directions[0] == optuna.study.StudyDirection.MAXIMIZE
+        objective = self.compute_objective(metrics.copy())
+        self.objective = self.metric_tracker.record(trial, step, metrics, objective, greater_is_better=maximize)
+        if len(directions) > 1:
+            # optuna can neither report nor prune intermediate values of multi-objective trials
+            return
+        trial.report(self.objective, step)
+        if trial.should_prune():
+            self.callback_handler.on_train_end(self.args, self.state, self.control)
+            raise optuna.TrialPruned()
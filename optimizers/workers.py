@@ -0,0 +1,65 @@
+import gc
+import multiprocessing
+import os
+
+import torch
+
+# trials that count towards the budget of a search run by several workers
+finished_states = ("COMPLETE", "PRUNED", "FAIL")
+
+
+def _run_worker(study_name, storage, objective, max_trials, timeout, threads, sampler):
+    import optuna
+
+    torch.set_num_threads(threads)
+    if sampler is not None:
+        # the workers would otherwise draw the same random numbers, from the state copied from the parent
+        sampler.reseed_rng()
+    # a new connection, the ones of the parent must not be used across the fork
+    study = optuna.load_study(study_name=study_name, storage=storage, sampler=sampler)
+    states = tuple(optuna.trial.TrialState[state] for state in finished_states)
+    study.optimize(objective, timeout=timeout, callbacks=[optuna.study.MaxTrialsCallback(max_trials, states=states)])
+
+
+def run_workers(study, storage, objective, n_trials, workers, timeout=None, sampler=None):
+    """
+    Runs `n_trials` more trials of `study` in `workers` processes forked from this one.
+
+    Everything the parent holds when it forks, e.g. the cached pretrained weights (see
+    [`~pretrained.cached_from_pretrained`]) and the encoded datasets, is shared with the workers copy-on-write instead of
+    being loaded again by each of them, so an extra worker only costs the memory of the model it trains. The workers
+    share the study through `storage`, the URL of the database it is kept in (e.g. `sqlite:///studies.db`), and each
+    gets an equal share of the CPU threads of torch. Every worker samples with its own reseeded copy of `sampler` (by
+    default the one of `optuna.load_study`), see [`~sampling.make_sampler`] for one that keeps the workers apart.
+
+    The workers stop starting trials once `n_trials` of them are finished, the trials running at that moment are still
+    finished, so a few more than `n_trials` may be run.
+    """
+    import optuna
+
+    states = tuple(optuna.trial.TrialState[state] for state in finished_states)
+    max_trials = len(study.get_trials(deepcopy=False, states=states)) + n_trials
+    threads = max(1, torch.get_num_threads() // workers)
+    # the tokenizers of the parent can not use their thread pool in the children
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_run_worker, args=(study.study_name, storage, objective, max_trials, timeout, threads,
+                                                  sampler))
+        for _ in range(workers)
+    ]
+    # objects that survived until now are not touched by the garbage collector of the children, so their pages stay
+    # shared instead of being copied
+    gc.collect()
+    gc.freeze()
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    finally:
+        gc.unfreeze()
+    failed = [process.exitcode for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of the {workers} trial workers failed (exit codes {failed}).")
@@ -0,0 +1,248 @@
+"""
+Runs the tuning and train scripts over the grid of tasks, optimizers, models and seeds on a pool of local workers:
+
+    python sweep.py run -d cola mrpc -o adam sgd -m bert -s 1 10 --threads 4 --memory 8 --tune_args="-n 20"
+    python sweep.py status
+
+Every task, optimizer and model is tuned once (the tuning scripts tune every seed), then trained on every seed with
+the hyperparameters tuned on that seed. A job starts once the jobs it needs are done and its CPU threads and memory
+fit in what the other running jobs left free. Its threads are pinned to CPUs of its own. The state of every job is
+kept in the status file of the sweep directory, and running the same sweep again only runs the jobs that are not
+done yet.
+"""
+import argparse
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+rootDir = os.path.dirname(os.path.realpath(__file__))
+
+tasks = ['cola', 'mnli', 'mrpc', 'sst2', 'stsb']
+optims = ['adam', 'adamw', 'nadam', 'adamax', 'adabound', 'sgd', 'sgdm']
+models = ['bert', 'roberta']
+seeds = [1, 10, 100, 1000, 10000]
+
+# states of the jobs in the status file, jobs in the last two are run again by the next sweep
+done, failed, running, pending = 'done', 'failed', 'running', 'pending'
+
+
+def bestruns_file(task, model, optim):
+    # written by the tuning scripts, next to the bestruns txt file
+    return task + '_' + model + '_' + optim + '_bestruns.json'
+
+
+def make_jobs(args):
+    """
+    Expands the grid into jobs, each a dict with its `name`, `command`, the `after` jobs it needs and its `threads`
+    and `memory` (in GB) reservations.
+    """
+    jobs = []
+    # the jobs that were run before with the same configuration and code only restore their results from it
+    cache = [] if args.cache is None else ['--cache', os.path.abspath(args.cache)]
+    for task in args.tasks:
+        for model in args.models:
+            for optim in args.optims:
+                tune = None
+                if 'tune' in args.stages:
+                    tune = '/'.join(['tune', task, model, optim])
+                    jobs.append({
+                        'name': tune,
+                        'command': [sys.executable, os.path.join(rootDir, 'tuning', task + '.py'), '-o', optim,
+                                    '-m', model, '-' + args.space] + cache + shlex.split(args.tune_args),
+                        'after': [],
+                        'threads': args.tune_threads or args.threads,
+                        'memory': args.tune_memory or args.memory,
+                    })
+                if 'train' not in args.stages:
+                    continue
+                for s in args.seeds:
+                    command = [sys.executable, os.path.join(rootDir, 'train', task + '.py'), '-o', optim, '-m', model,
+                               '-s', str(s)]
+                    hparams = bestruns_file(task, model, optim)
+                    if tune is not None or os.path.exists(os.path.join(args.dir, hparams)):
+                        command += ['--hparams', hparams]
+                    jobs.append({
+                        'name': '/'.join(['train', task, model, optim, 'seed_' + str(s)]),
+                        'command': command + cache + shlex.split(args.train_args),
+                        'after': [tune] if tune is not None else [],
+                        'threads': args.threads,
+                        'memory': args.memory,
+                    })
+    return jobs
+
+
+def load_status(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_status(path, status):
+    # replaced at once, so that `status` never reads a half written file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def available_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+
+def available_memory():
+    # in GB, the memory left free by what already runs (not the physical memory), the jobs started then reserve
+    # theirs from it
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 2**10 / 2**30
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 2**30
+
+
+def start(job, cpus, directory):
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cpus)), MKL_NUM_THREADS=str(len(cpus)),
+               TOKENIZERS_PARALLELISM='false')
+    log = os.path.join(directory, 'logs', job['name'].replace('/', '_') + '.log')
+    os.makedirs(os.path.dirname(log), exist_ok=True)
+
+    def pin():
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+
+    with open(log, 'a') as f:
+        process = subprocess.Popen(job['command'], cwd=directory, env=env, stdout=f, stderr=subprocess.STDOUT,
+                                   preexec_fn=pin, start_new_session=True)
+    return process, log
+
+
+def run(jobs, directory, cpus, memory, poll=5):
+    """
+    Runs `jobs` (see `make_jobs`) in `directory`, at most as many at a time as fit in `cpus` and `memory`, and keeps
+    their state in `directory/sweep.json`. Returns the number of jobs that are not done.
+    """
+    path = os.path.join(directory, 'sweep.json')
+    status = load_status(path)
+    for job in jobs:
+        entry = status.get(job['name'])
+        # a job is done for good unless it is now run differently
+        if entry is None or entry['state'] != done or entry['command'] != job['command']:
+            status[job['name']] = {'state': pending, 'command': job['command'], 'after': job['after'],
+                                   'threads': job['threads'], 'memory': job['memory']}
+    save_status(path, status)
+
+    queue = [job for job in jobs if status[job['name']]['state'] == pending]
+    free_cpus, free_memory = list(cpus), memory
+    processes = {}
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while queue or processes:
+            for job in list(queue):
+                states = [status[name]['state'] for name in job['after']]
+                if failed in states:
+                    status[job['name']].update(state=failed, reason='needs ' + ', '.join(job['after']))
+                    queue.remove(job)
+                    continue
+                if any(state != done for state in states):
+                    continue
+                threads = min(job['threads'], len(cpus))
+                # a job that does not fit even alone gets the whole machine
+                fits = threads <= len(free_cpus) and job['memory'] <= free_memory
+                if not fits and processes:
+                    continue
+                threads = min(threads, len(free_cpus))
+                job_cpus, free_cpus = free_cpus[:threads], free_cpus[threads:]
+                free_memory -= job['memory']
+                process, log = start(job, job_cpus, directory)
+                processes[job['name']] = (process, job_cpus, job['memory'])
+                status[job['name']].update(state=running, cpus=job_cpus, log=log, start=time.time(), pid=process.pid)
+                queue.remove(job)
+                print('started', job['name'], 'on', len(job_cpus), 'cpus', flush=True)
+            save_status(path, status)
+
+            time.sleep(poll)
+            for name, (process, job_cpus, job_memory) in list(processes.items()):
+                if process.poll() is None:
+                    continue
+                del processes[name]
+                free_cpus = sorted(free_cpus + job_cpus)
+                free_memory += job_memory
+                status[name].update(state=done if process.returncode == 0 else failed,
+                                    returncode=process.returncode, end=time.time())
+                print(status[name]['state'], name, flush=True)
+            save_status(path, status)
+    except KeyboardInterrupt:
+        for name, (process, _, _) in processes.items():
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            status[name].update(state=pending, end=time.time())
+        save_status(path, status)
+        raise
+    return sum(1 for job in jobs if status[job['name']]['state'] != done)
+
+
+def print_status(directory):
+    status = load_status(os.path.join(directory, 'sweep.json'))
+    counts = {}
+    for name, entry in status.items():
+        counts[entry['state']] = counts.get(entry['state'], 0) + 1
+        seconds = (entry.get('end') or time.time()) - entry['start'] if 'start' in entry else None
+        print('{:10} {:45} {}'.format(entry['state'], name, '' if seconds is None else '{:.0f}s'.format(seconds)))
+    print(', '.join(str(count) + ' ' + state for state, count in sorted(counts.items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tune and train over the grid of tasks, optimizers, models and seeds')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the jobs of the grid that are not done yet')
+    run_parser.add_argument("-d", "--tasks", nargs='+', choices=tasks, default = tasks)
+    run_parser.add_argument("-o", "--optims", nargs='+', choices=optims, default = optims)
+    run_parser.add_argument("-m", "--models", nargs='+', choices=models, default = models)
+    run_parser.add_argument("-s", "--seeds", nargs='+', type=int, choices=seeds, default = seeds,
+                            help="seeds of the train runs, the tuning scripts tune every seed")
+    run_parser.add_argument("--stages", nargs='+', choices=['tune', 'train'], default = ['tune', 'train'],
+                            help="without tune, the train runs use the hyperparameters of earlier sweeps if any")
+    run_parser.add_argument("--space", choices=['lr', 'all'], default = 'lr',
+                            help="tune only the learning rate or all the hyperparameters")
+    run_parser.add_argument("--tune_args", type=str, default = '', help="more arguments of the tuning scripts")
+    run_parser.add_argument("--train_args", type=str, default = '', help="more arguments of the train scripts")
+    run_parser.add_argument("--threads", type=int, default = 4, help="cpu threads reserved for every job")
+    run_parser.add_argument("--memory", type=float, default = 8, help="memory in GB reserved for every job")
+    run_parser.add_argument("--tune_threads", type=int, default = None,
+                            help="cpu threads reserved for every tuning job (default --threads), e.g. for -w")
+    run_parser.add_argument("--tune_memory", type=float, default = None,
+                            help="memory in GB reserved for every tuning job (default --memory)")
+    run_parser.add_argument("--cpus", type=int, default = None, help="cpus of the pool (default all)")
+    run_parser.add_argument("--total_memory", type=float, default = None, help="memory in GB of the pool (default all available)")
+    run_parser.add_argument("--cache", type=str, default = None,
+                            help="result cache of the jobs, e.g. shared by several sweeps (default cache in --dir)")
+    run_parser.add_argument("--dir", type=str, default = 'sweep',
+                            help="directory the jobs run in, with their results, logs and the status file")
+
+    status_parser = subparsers.add_parser('status', help='show the state of the jobs of a sweep')
+    status_parser.add_argument("--dir", type=str, default = 'sweep')
+
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+    if args.command == 'status':
+        print_status(args.dir)
+        sys.exit(0)
+
+    cpus = available_cpus()
+    if args.cpus is not None:
+        cpus = cpus[:args.cpus]
+    memory = available_memory() if args.total_memory is None else args.total_memory
+    left = run(make_jobs(args), os.path.abspath(args.dir), cpus, memory)
+    print_status(args.dir)
+    sys.exit(1 if left else 0)
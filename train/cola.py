@@ -1,9 +1,10 @@
 import argparse
+import json
 import random
 import numpy as np
 import torch
 from transformers.file_utils import is_tf_available, is_torch_available
-from datasets import load_dataset, load_metric, concatenate_datasets
+from datasets import concatenate_datasets
 import pandas as pd
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 from sklearn.metrics import f1_score, precision_recall_curve, auc
@@ -14,6 +15,12 @@ rootDir = os.path.abspath(os.path.join(currDir, '..'))
 if rootDir not in sys.path: # add parent dir to paths
     sys.path.append(rootDir)
 
+from optimizers.encoding_cache import cached_map, default_cache_dir
+from optimizers.glue import GlueMetric, load_glue
+from optimizers.pretrained import cached_from_pretrained
+from optimizers.result_cache import restore_result, result_key, run_config, store_result
+from optimizers.run_dir import artifacts, run_dir_name
+
 parser = argparse.ArgumentParser(description='set model, optimizer and if you want to tune all hyperparams or only lr')
 
 parser.add_argument("-o", "--optim", type=str, choices=['adabound','nadam','adamw','adam', 'adamax', 'sgd', 'sgdm'],
@@ -28,6 +35,35 @@ parser.add_argument("-s", "--seed", type=int, choices=[1,10,100,1000,10000],
 
 
 
+parser.add_argument("--hparams", type=str, default = None,
+                    help="bestruns json file of the tuning script, to train with the hyperparameters tuned on the seed")
+parser.add_argument("--group_by_length", action='store_true',
+                    help="batch examples of similar length together, the evaluation batches are sorted by length")
+parser.add_argument("--auto_batch_size", action='store_true',
+                    help="probe batch sizes before training and use the fastest ones that fit in memory, see --lr_scaling")
+parser.add_argument("--max_batch_size", type=int, default = 256,
+                    help="largest batch size probed by --auto_batch_size")
+parser.add_argument("--memory_limit", type=float, default = None,
+                    help="peak memory in GB a batch size must stay below to be picked by --auto_batch_size (on cpu, what its steps add to the process)")
+parser.add_argument("--lr_scaling", choices=['none', 'linear', 'sqrt'], default = 'none',
+                    help="how the learning rate follows the batch size picked by --auto_batch_size, --max_tokens or --pack_length")
+parser.add_argument("--max_tokens", type=int, default = None,
+                    help="make the training batches of as many sentences as fit in this many padded tokens instead of a fixed number")
+parser.add_argument("--pack_length", type=int, default = None,
+                    help="pack the training sentences into rows of this many tokens, each attending only to itself, the batch size counts rows")
+parser.add_argument("--data_cache", type=str, default = default_cache_dir,
+                    help="directory of the datasets read from data/ and of the tokenized datasets, shared by every script and run of the host, '' disables it")
+parser.add_argument("--tokenize_procs", type=int, default = None,
+                    help="processes tokenizing the datasets that are not in --data_cache yet (default one per available cpu)")
+parser.add_argument("--cache", type=str, default = 'cache',
+                    help="directory of the result cache, runs whose configuration and code are in it are not run again, '' disables it")
+parser.add_argument("--rerun", action='store_true',
+                    help="run even if the result is in the cache, and replace it")
+parser.add_argument("--run_root", type=str, default = 'runs',
+                    help="directory the runs get their own directory in, e.g. /dev/shm")
+parser.add_argument("--keep", nargs='*', choices=artifacts, default = [],
+                    help="what to keep of the runs once they end (checkpoints, logs), by default they are deleted")
+
 args = parser.parse_args()
 
 
@@ -110,7 +146,8 @@ num_labels = 3 if task.startswith("mnli") else 1 if task == "stsb" else 2
 
 
 def model_init():
-    model = AutoModelForSequenceClassification.from_pretrained(model_checkpoint, num_labels=num_labels)
+    # the weights are read from the checkpoint once, every trial gets a copy with a new classification head
+    model = cached_from_pretrained(model_checkpoint, num_labels=num_labels)
     return model
 
     
@@ -137,8 +174,8 @@ def compute_metrics(eval_pred):
 
 
 actual_task = "mnli" if task == "mnli-mm" else task
-dataset = load_dataset("glue", actual_task)
-metric = load_metric('glue', actual_task)
+dataset = load_glue(actual_task, cache_dir=args.data_cache)
+metric = GlueMetric(actual_task)
 
 dataset1 = concatenate_datasets([dataset["train"], dataset["validation"]])
 
@@ -150,9 +187,44 @@ test = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_colu
 
 
 
-encoded_train = train.map(preprocess_function, batched=True)
-encoded_valid = valid.map(preprocess_function, batched=True)
-encoded_test = test.map(preprocess_function, batched=True)
+# Evaluate during training and a bit more often
+# than the default to be able to prune bad trials early.
+# Disabling tqdm is a matter of preference.
+# created when the training starts, not for a run restored from the result cache
+run_dir = run_dir_name(args.run_root, '_'.join([task, args.model, args.optim, 'seed', str(s)]))
+training_args = MyTrainingArguments(run_dir, do_eval=True,
+                                    eval_steps=500,
+                                    optim=optim,
+                                    per_device_train_batch_size=4,
+                                    per_device_eval_batch_size=4,
+                                    group_by_length=args.group_by_length,
+                                    evaluation_strategy="steps",
+                                    logging_steps=500,
+                                    save_total_limit=2,
+                                    warmup_steps=500,
+                                    num_train_epochs=10,
+                                    load_best_model_at_end=True,
+                                    logging_dir=run_dir,
+                                    disable_tqdm=False,
+                                    )
+if args.hparams is not None:
+    with open(args.hparams) as f:
+        for key, value in json.load(f)[str(s)].items():
+            setattr(training_args, key, value)
+
+# a run with the same configuration and code is not trained again, its result file is restored from the cache before
+# the data is tokenized and the trainer is built
+result_file = task+'_'+args.model+'_'+ args.optim+'_seed_'+ str(s)+'.txt'
+result_config = dict(run_config(training_args, MyTrainer, args, train, valid), task=task, seed=s,
+                     checkpoint=model_checkpoint, tokenizer=tokenizer.name_or_path)
+run_key = result_key(result_config)
+if args.cache and not args.rerun and restore_result(args.cache, run_key, [result_file]):
+    print(result_file + ' restored from ' + args.cache)
+    sys.exit(0)
+
+encoded_train = cached_map(train, preprocess_function, tokenizer, task, args.data_cache, num_proc=args.tokenize_procs)
+encoded_valid = cached_map(valid, preprocess_function, tokenizer, task, args.data_cache, num_proc=args.tokenize_procs)
+encoded_test = cached_map(test, preprocess_function, tokenizer, task, args.data_cache, num_proc=args.tokenize_procs)
 
 
 
@@ -248,23 +320,6 @@ def eval_and_predict(data, y):
 
 
 
-# Evaluate during training and a bit more often
-# than the default to be able to prune bad trials early.
-# Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments("1", do_eval=True,
-                                    eval_steps=500,
-                                    optim=optim,
-                                    per_device_train_batch_size=4,
-                                    per_device_eval_batch_size=4,
-                                    evaluation_strategy="steps",
-                                    logging_steps=500,
-                                    save_total_limit=2,
-                                    warmup_steps=500,
-                                    num_train_epochs=10,
-                                    load_best_model_at_end=True,
-                                    logging_dir="1",
-                                    disable_tqdm=False,
-                                    )
 
 trainer = MyTrainer(
     args=training_args,
@@ -272,12 +327,20 @@ trainer = MyTrainer(
     train_dataset=encoded_train,
     eval_dataset=encoded_valid,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep
 )
+if args.pack_length:
+    trainer.use_packing(args.pack_length, lr_scaling=args.lr_scaling)
+elif args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 trainer.train()
 
-f = open(task+'_'+args.model+'_'+ args.optim+'_seed_'+ str(s)+'.txt', 'w')
+f = open(result_file, 'w')
 
 f.write('TRAIN:' + '\n')
 pos_prec, pos_recall, neg_prec, neg_recall = eval_and_predict(encoded_train, train['label'])
@@ -303,4 +366,7 @@ f.write('f1 macro: ' +str(trainer.evaluate(encoded_test).get('eval_macro_f1') *
 f.write('\n')
 
 
-f.close()
\ No newline at end of file
+f.close()
+
+if args.cache:
+    store_result(args.cache, run_key, result_config, [result_file])
@@ -1,4 +1,5 @@
 import argparse
+import json
 import pandas as pd
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 from sklearn import metrics
@@ -18,6 +19,11 @@ rootDir = os.path.abspath(os.path.join(currDir, '..'))
 if rootDir not in sys.path: # add parent dir to paths
     sys.path.append(rootDir)
 
+from optimizers.encoding_cache import cached_encode, default_cache_dir
+from optimizers.pretrained import cached_from_pretrained
+from optimizers.result_cache import restore_result, result_key, run_config, store_result
+from optimizers.run_dir import artifacts, run_dir_name
+
 
 parser = argparse.ArgumentParser(description='set model, optimizer and if you want to tune all hyperparams or only lr')
 
@@ -33,6 +39,35 @@ parser.add_argument("-s", "--seed", type=int, choices=[1,10,100,1000,10000],
 
 
 
+parser.add_argument("--hparams", type=str, default = None,
+                    help="bestruns json file of the tuning script, to train with the hyperparameters tuned on the seed")
+parser.add_argument("--group_by_length", action='store_true',
+                    help="batch examples of similar length together, the evaluation batches are sorted by length")
+parser.add_argument("--auto_batch_size", action='store_true',
+                    help="probe batch sizes before training and use the fastest ones that fit in memory, see --lr_scaling")
+parser.add_argument("--max_batch_size", type=int, default = 256,
+                    help="largest batch size probed by --auto_batch_size")
+parser.add_argument("--memory_limit", type=float, default = None,
+                    help="peak memory in GB a batch size must stay below to be picked by --auto_batch_size (on cpu, what its steps add to the process)")
+parser.add_argument("--lr_scaling", choices=['none', 'linear', 'sqrt'], default = 'none',
+                    help="how the learning rate follows the batch size picked by --auto_batch_size, --max_tokens or --pack_length")
+parser.add_argument("--max_tokens", type=int, default = None,
+                    help="make the training batches of as many sentences as fit in this many padded tokens instead of a fixed number")
+parser.add_argument("--pack_length", type=int, default = None,
+                    help="pack the training sentences into rows of this many tokens, each attending only to itself, the batch size counts rows")
+parser.add_argument("--data_cache", type=str, default = default_cache_dir,
+                    help="directory of the datasets read from data/ and of the tokenized datasets, shared by every script and run of the host, '' disables it")
+parser.add_argument("--tokenize_procs", type=int, default = None,
+                    help="processes tokenizing the datasets that are not in --data_cache yet (default one per available cpu)")
+parser.add_argument("--cache", type=str, default = 'cache',
+                    help="directory of the result cache, runs whose configuration and code are in it are not run again, '' disables it")
+parser.add_argument("--rerun", action='store_true',
+                    help="run even if the result is in the cache, and replace it")
+parser.add_argument("--run_root", type=str, default = 'runs',
+                    help="directory the runs get their own directory in, e.g. /dev/shm")
+parser.add_argument("--keep", nargs='*', choices=artifacts, default = [],
+                    help="what to keep of the runs once they end (checkpoints, logs), by default they are deleted")
+
 args = parser.parse_args()
 
 
@@ -68,7 +103,8 @@ elif optim == "sgdm":
 tokenizer = AutoTokenizer.from_pretrained(model_checkpoint,do_lower_case=True)
 
 def model_init():
-    model = AutoModelForSequenceClassification.from_pretrained(model_checkpoint, num_labels=num_labels)
+    # the weights are read from the checkpoint once, every trial gets a copy with a new classification head
+    model = cached_from_pretrained(model_checkpoint, num_labels=num_labels)
     return model
     
 #Precision-Recall-F1s
@@ -215,65 +251,82 @@ def compute_metrics(pred):
     }
 
 
-train_reviews, extra_reviews, train_sentiments, extra_sentiments = train_test_split(train_reviews, train_sentiments, test_size=1-15000/len(train_sentiments), random_state=s,stratify=train_sentiments)
-valid_reviews, extra_reviews , valid_sentiments , extra_sentiments = train_test_split(extra_reviews, extra_sentiments, test_size=1-1500/len(extra_sentiments), random_state=s,stratify=extra_sentiments)
-test_reviews, non_used_reviews , test_sentiments , non_used_sentiments = train_test_split(extra_reviews, extra_sentiments, test_size=1-1500/len(extra_sentiments), random_state=s,stratify=extra_sentiments)
+# the splits are rows of the whole training set, the same train_test_split makes of the sentences themselves
+all_rows = np.arange(len(train_sentiments))
+train_rows, extra_rows = train_test_split(all_rows, test_size=1-15000/len(all_rows), random_state=s, stratify=train_sentiments)
+valid_rows, extra_rows = train_test_split(extra_rows, test_size=1-1500/len(extra_rows), random_state=s, stratify=train_sentiments[extra_rows])
+test_rows, non_used_rows = train_test_split(extra_rows, test_size=1-1500/len(extra_rows), random_state=s, stratify=train_sentiments[extra_rows])
 
 
 MAX_SEQ_LENGTH = 268
 
-train_encodings = tokenizer(train_reviews.tolist(), truncation=True, padding=True, max_length=MAX_SEQ_LENGTH)
-valid_encodings = tokenizer(valid_reviews.tolist(), truncation=True, padding=True, max_length=MAX_SEQ_LENGTH)
-test_encodings = tokenizer(test_reviews.tolist(), truncation=True, padding=True, max_length=MAX_SEQ_LENGTH)
-
-# DataLoader consists of encodings (Xs) and labels (Ys)
-class SST2(torch.utils.data.Dataset):
-    def __init__(self, encodings, labels):
-        self.encodings = encodings
-        self.labels = labels
-
-    def __getitem__(self, idx):
-        item = {k: torch.tensor(v[idx]) for k, v in self.encodings.items()}
-        item["labels"] = torch.tensor([self.labels[idx]])
-        return item
-
-    def __len__(self):
-        return len(self.labels)
-
-# Convert our tokenized data into a torch Dataset
-train_dataset = SST2(train_encodings, train_sentiments)
-valid_dataset = SST2(valid_encodings, valid_sentiments)
-test_dataset = SST2(test_encodings, test_sentiments)
-
 # Evaluate during training and a bit more often
 # than the default to be able to prune bad trials early.
 # Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments( "1",do_eval=True, 
+# created when the training starts, not for a run restored from the result cache
+run_dir = run_dir_name(args.run_root, '_'.join([task, args.model, args.optim, 'seed', str(s)]))
+training_args = MyTrainingArguments( run_dir,do_eval=True, 
     eval_steps=500,
     optim = optim,
     per_device_train_batch_size=4,
     per_device_eval_batch_size=4,
+    group_by_length=args.group_by_length,
     evaluation_strategy="steps",
     logging_steps=500,
     warmup_steps= 500,
     save_total_limit = 2,
     num_train_epochs = 4,
     load_best_model_at_end = True,
-    logging_dir="1", 
+    logging_dir=run_dir, 
     disable_tqdm=False)
+if args.hparams is not None:
+    with open(args.hparams) as f:
+        for key, value in json.load(f)[str(s)].items():
+            setattr(training_args, key, value)
+
+# a run with the same configuration and code is not trained again, its result file is restored from the cache before
+# the data is tokenized and the trainer is built
+result_file = task+'_'+args.model+'_'+ args.optim+'_seed_'+ str(s)+'.txt'
+result_config = dict(run_config(training_args, MyTrainer, args), task=task, seed=s,
+                     checkpoint=model_checkpoint, tokenizer=tokenizer.name_or_path)
+run_key = result_key(result_config)
+if args.cache and not args.rerun and restore_result(args.cache, run_key, [result_file]):
+    print(result_file + ' restored from ' + args.cache)
+    sys.exit(0)
+
+# not padded, every batch is padded to its own longest sentence by encoded.collate, see EncodedDataset. The whole
+# training set is tokenized once per host and shared with the tuning script, see cached_encode
+encoded = cached_encode(train_reviews, train_sentiments, tokenizer, task, args.data_cache,
+                        num_proc=args.tokenize_procs, truncation=True, max_length=MAX_SEQ_LENGTH)
+
+train_dataset = encoded.select(train_rows)
+valid_dataset = encoded.select(valid_rows)
+test_dataset = encoded.select(test_rows)
+train_sentiments, valid_sentiments, test_sentiments = (encoded.labels[train_rows], encoded.labels[valid_rows],
+                                                       encoded.labels[test_rows])
+
 
 trainer = MyTrainer(
     args=training_args,
     tokenizer=tokenizer,
+    data_collator=encoded.collate,
     train_dataset=train_dataset,
     eval_dataset=valid_dataset,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep
 )
+if args.pack_length:
+    trainer.use_packing(args.pack_length, lr_scaling=args.lr_scaling)
+elif args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 trainer.train()
 
-f = open(task+'_'+args.model+'_'+ args.optim+'_seed_'+ str(s)+'.txt', 'w')
+f = open(result_file, 'w')
 
 f.write('TRAIN:' + '\n')
 pos_prec, pos_recall, neg_prec, neg_recall = eval_and_predict(train_dataset, train_sentiments)
@@ -291,3 +344,6 @@ f.write('Accuracy: ' + str(trainer.evaluate(test_dataset).get('eval_accuracy'))
 f.write('\n')
 
 f.close()
+
+if args.cache:
+    store_result(args.cache, run_key, result_config, [result_file])
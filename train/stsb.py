@@ -1,5 +1,6 @@
 import argparse
-from datasets import load_dataset, load_metric, concatenate_datasets
+import json
+from datasets import concatenate_datasets
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 import random
 import numpy as np
@@ -12,6 +13,13 @@ currDir = os.path.dirname(os.path.realpath(__file__))
 rootDir = os.path.abspath(os.path.join(currDir, '..'))
 if rootDir not in sys.path: # add parent dir to paths
     sys.path.append(rootDir)
+
+from optimizers.encoding_cache import cached_map, default_cache_dir
+from optimizers.glue import GlueMetric, load_glue
+from optimizers.pretrained import cached_from_pretrained
+from optimizers.result_cache import restore_result, result_key, run_config, store_result
+from optimizers.run_dir import artifacts, run_dir_name
+from optimizers.tokenization import PairEncoder
     
 
 parser = argparse.ArgumentParser(description='set model, optimizer and if you want to tune all hyperparams or only lr')
@@ -28,6 +36,33 @@ parser.add_argument("-s", "--seed", type=int, choices=[1,10,100,1000,10000],
 
 
 
+parser.add_argument("--hparams", type=str, default = None,
+                    help="bestruns json file of the tuning script, to train with the hyperparameters tuned on the seed")
+parser.add_argument("--group_by_length", action='store_true',
+                    help="batch examples of similar length together, the evaluation batches are sorted by length")
+parser.add_argument("--auto_batch_size", action='store_true',
+                    help="probe batch sizes before training and use the fastest ones that fit in memory, see --lr_scaling")
+parser.add_argument("--max_batch_size", type=int, default = 256,
+                    help="largest batch size probed by --auto_batch_size")
+parser.add_argument("--memory_limit", type=float, default = None,
+                    help="peak memory in GB a batch size must stay below to be picked by --auto_batch_size (on cpu, what its steps add to the process)")
+parser.add_argument("--lr_scaling", choices=['none', 'linear', 'sqrt'], default = 'none',
+                    help="how the learning rate follows the batch size picked by --auto_batch_size or --max_tokens")
+parser.add_argument("--max_tokens", type=int, default = None,
+                    help="make the training batches of as many sentences as fit in this many padded tokens instead of a fixed number")
+parser.add_argument("--data_cache", type=str, default = default_cache_dir,
+                    help="directory of the datasets read from data/ and of the tokenized datasets, shared by every script and run of the host, '' disables it")
+parser.add_argument("--tokenize_procs", type=int, default = None,
+                    help="processes tokenizing the datasets that are not in --data_cache yet (default one per available cpu)")
+parser.add_argument("--cache", type=str, default = 'cache',
+                    help="directory of the result cache, runs whose configuration and code are in it are not run again, '' disables it")
+parser.add_argument("--rerun", action='store_true',
+                    help="run even if the result is in the cache, and replace it")
+parser.add_argument("--run_root", type=str, default = 'runs',
+                    help="directory the runs get their own directory in, e.g. /dev/shm")
+parser.add_argument("--keep", nargs='*', choices=artifacts, default = [],
+                    help="what to keep of the runs once they end (checkpoints, logs), by default they are deleted")
+
 args = parser.parse_args()
 
 
@@ -105,17 +140,22 @@ task_to_keys = {
 
 sentence1_key, sentence2_key = task_to_keys[task]
 
+# every distinct sentence is tokenized once, the pairs are the ones of the tokenizer, see PairEncoder
+pair_encoder = PairEncoder(tokenizer, truncation=True)
+
+
 def preprocess_function(examples):
     if sentence2_key is None:
         return tokenizer(examples[sentence1_key], truncation=True)
-    return tokenizer(examples[sentence1_key], examples[sentence2_key], truncation=True)
+    return pair_encoder(examples[sentence1_key], examples[sentence2_key])
 
 
 
 num_labels = 3 if task.startswith("mnli") else 1 if task=="stsb" else 2
 
 def model_init():
-    model = AutoModelForSequenceClassification.from_pretrained(model_checkpoint, num_labels=num_labels)
+    # the weights are read from the checkpoint once, every trial gets a copy with a new classification head
+    model = cached_from_pretrained(model_checkpoint, num_labels=num_labels)
     return model
 
 
@@ -126,8 +166,8 @@ def model_init():
 ## Loading the dataset
 
 actual_task = "mnli" if task == "mnli-mm" else task
-dataset = load_dataset("glue", actual_task)
-metric = load_metric('glue', actual_task)
+dataset = load_glue(actual_task, cache_dir=args.data_cache)
+metric = GlueMetric(actual_task)
 dataset1 = concatenate_datasets([dataset["train"],dataset["validation"]])
 print (metric)
 
@@ -139,38 +179,56 @@ train = dataset2["train"]
 valid = dataset2["test"].train_test_split(test_size=0.5,seed=s)["train"]
 test = dataset2["test"].train_test_split(test_size=0.5,seed=s)["test"]
 
-encoded_train = train.map(preprocess_function, batched=True)
-encoded_valid= valid.map(preprocess_function, batched=True)
-encoded_test = test.map(preprocess_function, batched=True)
-
-def compute_metrics(eval_pred):
-    predictions, labels = eval_pred
-    predictions = predictions[:, 0]
-    results = metric.compute(predictions=predictions, references=labels)
-    rmse = mean_squared_error(y_true=labels, y_pred=predictions, squared=False)
-    pearson = round(results["pearson"], 2)
-    spearmanr = round(results["spearmanr"], 2)
-    return {
-        'pearson': pearson, "spearmanr": spearmanr, 'rmse': rmse
-    }
-
 # Evaluate during training and a bit more often
 # than the default to be able to prune bad trials early.
 # Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments( "1",do_eval=True, 
+# created when the training starts, not for a run restored from the result cache
+run_dir = run_dir_name(args.run_root, '_'.join([task, args.model, args.optim, 'seed', str(s)]))
+training_args = MyTrainingArguments( run_dir,do_eval=True, 
     eval_steps=500,
     optim = optim,
     per_device_train_batch_size=4,
     per_device_eval_batch_size=4,
+    group_by_length=args.group_by_length,
     evaluation_strategy="steps",
     logging_steps=500,
     save_total_limit = 2,
     warmup_steps= 500,
     num_train_epochs = 1,#12,
     load_best_model_at_end = True,
-    logging_dir="1", 
+    logging_dir=run_dir, 
     disable_tqdm=False
    )
+if args.hparams is not None:
+    with open(args.hparams) as f:
+        for key, value in json.load(f)[str(s)].items():
+            setattr(training_args, key, value)
+
+# a run with the same configuration and code is not trained again, its result file is restored from the cache before
+# the data is tokenized and the trainer is built
+result_file = task+'_'+args.model+'_'+ args.optim+'_seed_'+ str(s)+'.txt'
+result_config = dict(run_config(training_args, MyTrainer, args, train, valid), task=task, seed=s,
+                     checkpoint=model_checkpoint, tokenizer=tokenizer.name_or_path)
+run_key = result_key(result_config)
+if args.cache and not args.rerun and restore_result(args.cache, run_key, [result_file]):
+    print(result_file + ' restored from ' + args.cache)
+    sys.exit(0)
+
+encoded_train = cached_map(train, preprocess_function, tokenizer, task, args.data_cache, num_proc=args.tokenize_procs)
+encoded_valid= cached_map(valid, preprocess_function, tokenizer, task, args.data_cache, num_proc=args.tokenize_procs)
+encoded_test = cached_map(test, preprocess_function, tokenizer, task, args.data_cache, num_proc=args.tokenize_procs)
+
+def compute_metrics(eval_pred):
+    predictions, labels = eval_pred
+    predictions = predictions[:, 0]
+    results = metric.compute(predictions=predictions, references=labels)
+    rmse = mean_squared_error(y_true=labels, y_pred=predictions, squared=False)
+    pearson = round(results["pearson"], 2)
+    spearmanr = round(results["spearmanr"], 2)
+    return {
+        'pearson': pearson, "spearmanr": spearmanr, 'rmse': rmse
+    }
+
 
 trainer = MyTrainer(
     args=training_args,
@@ -178,16 +236,25 @@ trainer = MyTrainer(
     train_dataset=encoded_train,
     eval_dataset=encoded_valid,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep
 )
+if args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 trainer.train()
 
 
 
-f = open(task+'_'+args.model+'_'+ args.optim+'_seed_'+ str(s)+'.txt', 'w')
+f = open(result_file, 'w')
 
 f.write('For train: ' + str(trainer.evaluate(encoded_train)) + '\n' + 'For valid: ' + str(
     trainer.evaluate(encoded_valid)) + '\n' + 'For test: ' + str(trainer.evaluate(encoded_test)))
 
-f.close()
\ No newline at end of file
+f.close()
+
+if args.cache:
+    store_result(args.cache, run_key, result_config, [result_file])
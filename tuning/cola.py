@@ -1,9 +1,10 @@
 import argparse
+import json
 import random
 import numpy as np
 import torch
 from transformers.file_utils import is_tf_available, is_torch_available
-from datasets import load_dataset, load_metric, concatenate_datasets
+from datasets import concatenate_datasets
 import pandas as pd
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
@@ -13,6 +14,13 @@ rootDir = os.path.abspath(os.path.join(currDir, '..'))
 if rootDir not in sys.path: # add parent dir to paths
     sys.path.append(rootDir)
 
+from optimizers.encoding_cache import cached_map, default_cache_dir
+from optimizers.glue import GlueMetric, load_glue
+from optimizers.pretrained import cached_from_pretrained
+from optimizers.result_cache import restore_result, result_key, store_result
+from optimizers.run_dir import artifacts, make_run_dir
+from optimizers.sampling import make_sampler, samplers
+
 
 parser = argparse.ArgumentParser(description='set model, optimizer and if you want to tune all hyperparams or only lr')
 
@@ -25,6 +33,53 @@ parser.add_argument('-lr', dest='only_lr', action='store_true',
                     help='Set the only_lr value to True.')
 parser.add_argument('-all', dest='only_lr', action='store_false',
                     help='Set the only_lr value to False.')
+parser.add_argument("-n", "--n_trials", type=int, default = 30,
+                    help="number of trials per seed")
+parser.add_argument("-k", "--warm_start", type=int, default = 0,
+                    help="start the study of every seed from the k best configurations of the seeds tuned before it")
+parser.add_argument("-t", "--transfer", type=int, default = 0,
+                    help="also start it from the k best configurations of every related optimizer tuned on the same seed")
+parser.add_argument("--storage", type=str, default = None,
+                    help="optuna storage url of the studies, e.g. sqlite:///studies.db, needed to transfer between optimizers")
+parser.add_argument("--target", type=float, default = None,
+                    help="stop every trial once the metric reaches this value and tune for both the metric and the time to reach it")
+parser.add_argument("--pbt", type=int, default = 0,
+                    help="train a population of this size with population based training instead of the independent trials")
+parser.add_argument("--best_weights", choices=['ram', 'fp16', 'disk'], default = 'ram',
+                    help="keep the weights of the best evaluation of every trial in RAM, in RAM as fp16, or in checkpoints on disk")
+
+parser.add_argument("-w", "--workers", type=int, default = 1,
+                    help="run the trials in this many processes forked after the data and the pretrained weights are loaded")
+parser.add_argument("--sampler", choices=samplers, default = 'liar',
+                    help="tpe, or liar to keep the trials running at the same time (-w, --pbt) apart")
+parser.add_argument("--dedup", type=float, default = 0,
+                    help="prune trials within this fraction of the range of every hyperparameter of an earlier one, e.g. 0.01 (default 0, disabled)")
+parser.add_argument("--group_by_length", action='store_true',
+                    help="batch examples of similar length together, the evaluation batches are sorted by length")
+parser.add_argument("--auto_batch_size", action='store_true',
+                    help="probe batch sizes before training and use the fastest ones that fit in memory, see --lr_scaling")
+parser.add_argument("--max_batch_size", type=int, default = 256,
+                    help="largest batch size probed by --auto_batch_size")
+parser.add_argument("--memory_limit", type=float, default = None,
+                    help="peak memory in GB a batch size must stay below to be picked by --auto_batch_size (on cpu, what its steps add to the process)")
+parser.add_argument("--lr_scaling", choices=['none', 'linear', 'sqrt'], default = 'none',
+                    help="how the learning rate follows the batch size picked by --auto_batch_size, --max_tokens or --pack_length")
+parser.add_argument("--max_tokens", type=int, default = None,
+                    help="make the training batches of as many sentences as fit in this many padded tokens instead of a fixed number")
+parser.add_argument("--pack_length", type=int, default = None,
+                    help="pack the training sentences into rows of this many tokens, each attending only to itself, the batch size counts rows")
+parser.add_argument("--data_cache", type=str, default = default_cache_dir,
+                    help="directory of the datasets read from data/ and of the tokenized datasets, shared by every script and run of the host, '' disables it")
+parser.add_argument("--tokenize_procs", type=int, default = None,
+                    help="processes tokenizing the datasets that are not in --data_cache yet (default one per available cpu)")
+parser.add_argument("--cache", type=str, default = 'cache',
+                    help="directory of the result cache, runs whose configuration and code are in it are not run again, '' disables it")
+parser.add_argument("--rerun", action='store_true',
+                    help="run even if the result is in the cache, and replace it")
+parser.add_argument("--run_root", type=str, default = 'runs',
+                    help="directory the runs get their own directory in, e.g. /dev/shm")
+parser.add_argument("--keep", nargs='*', choices=artifacts, default = [],
+                    help="what to keep of the runs once they end (checkpoints, logs), by default they are deleted")
 
 args = parser.parse_args()
 
@@ -60,6 +115,32 @@ if only_lr:
 else:
     optuna = my_hp_space_optuna
 
+from optimizers.callbacks import BestWeightsCallback, DivergenceCallback
+from tuning.data import split_indices
+from tuning.warm_start import SeedWarmStart, study_prefix, related_prefixes
+
+# a tuning with the same arguments and code is not run again, its bestruns files are restored from the cache
+result_files = [task + '_'+ args.model + '_' + args.optim + '_bestruns.txt',
+                task + '_'+ args.model + '_' + args.optim + '_bestruns.json']
+result_config = dict({k: v for k, v in vars(args).items()
+                      if k not in ['run_root', 'keep', 'cache', 'data_cache', 'tokenize_procs', 'rerun']},
+                     task=task, checkpoint=model_checkpoint)
+run_key = result_key(result_config)
+if args.cache and not args.rerun and restore_result(args.cache, run_key, result_files):
+    print(', '.join(result_files) + ' restored from ' + args.cache)
+    sys.exit(0)
+
+if args.workers > 1 and args.storage is None:
+    # the workers share the studies through a database
+    args.storage = 'sqlite:///' + os.path.join(make_run_dir(args.run_root, 'studies'), 'studies.db')
+warm_start = SeedWarmStart(study_prefix(task, args.model, args.optim, only_lr, args.target), top_k=args.warm_start,
+                           storage=args.storage, related=related_prefixes(task, args.model, args.optim, args.target),
+                           transfer_k=args.transfer, hp_space=optuna,
+                           directions=['maximize'] if args.target is None else ['maximize', 'minimize'])
+# without checkpoints, the weights of the best evaluation are kept in memory
+best_weights = [] if args.best_weights == 'disk' else \
+    [BestWeightsCallback(dtype=torch.float16 if args.best_weights == 'fp16' else None)]
+
 # Custom seed
 def set_seed(seed: int):
     """
@@ -111,67 +192,63 @@ num_labels = 3 if task.startswith("mnli") else 1 if task == "stsb" else 2
 
 
 def model_init():
-    model = AutoModelForSequenceClassification.from_pretrained(model_checkpoint, num_labels=num_labels)
+    # the weights are read from the checkpoint once, every trial gets a copy with a new classification head
+    model = cached_from_pretrained(model_checkpoint, num_labels=num_labels)
     return model
 
 
+# metric of a single evaluation, every trial reports the best one it reached
 def compute_metrics(eval_pred):
     predictions, labels = eval_pred
     predictions = np.argmax(predictions, axis=1)
-    print(id[0])
-    if id[0] != trainer.run_id():
-        global matthews
-        matthews = []
-    matthews.append(metric.compute(predictions=predictions, references=labels)['matthews_correlation'])
-    print(metric.compute(predictions=predictions, references=labels)['matthews_correlation'])
-    id[0] = trainer.run_id()
     return {
-        'matthews_correlation': max(matthews),
+        'matthews_correlation': metric.compute(predictions=predictions, references=labels)['matthews_correlation'],
     }
 
+
 # Loading the dataset
 
 
 actual_task = "mnli" if task == "mnli-mm" else task
-dataset = load_dataset("glue", actual_task)
-metric = load_metric('glue', actual_task)
+dataset = load_glue(actual_task, cache_dir=args.data_cache)
+metric = GlueMetric(actual_task)
 
 dataset1 = concatenate_datasets([dataset["train"], dataset["validation"]])
 
 
 
+# tokenized once per host (see cached_map), the splits of every seed are views of it
+encoded_dataset1 = cached_map(dataset1, preprocess_function, tokenizer, task, args.data_cache,
+                              num_proc=args.tokenize_procs)
+
 # SPLIT DATA (seed = 1)
 s = 1
-dataset2 = dataset1.train_test_split(test_size=0.1666666666666, seed=s, stratify_by_column='label')
-
-train = dataset2["train"]
-valid = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["train"]
-test = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["test"]
-
+train_rows, valid_test_rows = split_indices(dataset1, 0.1666666666666, s, 'label')
+valid_rows, test_rows = split_indices(dataset1, 0.5, s, 'label', rows=valid_test_rows)
 
-
-encoded_train = train.map(preprocess_function, batched=True)
-encoded_valid = valid.map(preprocess_function, batched=True)
-encoded_test = test.map(preprocess_function, batched=True)
+encoded_train = encoded_dataset1.select(train_rows)
+encoded_valid = encoded_dataset1.select(valid_rows)
+encoded_test = encoded_dataset1.select(test_rows)
 
 # Hyperparameter Search
-matthews = [-3]
-id = [-1]
 # Evaluate during training and a bit more often
 # than the default to be able to prune bad trials early.
 # Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments("1", do_eval=True,
+run_dir = make_run_dir(args.run_root, warm_start.study_name(s))
+training_args = MyTrainingArguments(run_dir, do_eval=True,
                                     eval_steps=500,
                                     optim=optim,
                                     per_device_train_batch_size=4,
                                     per_device_eval_batch_size=4,
+                                    group_by_length=args.group_by_length,
                                     evaluation_strategy="steps",
                                     logging_steps=500,
+                                    save_strategy="steps" if args.best_weights == 'disk' else "no",
                                     save_total_limit=2,
                                     warmup_steps=500,
                                     num_train_epochs=10,
-                                    load_best_model_at_end=True,
-                                    logging_dir="1",
+                                    load_best_model_at_end=args.best_weights == 'disk',
+                                    logging_dir=run_dir,
                                     disable_tqdm=False,
                                     )
 
@@ -181,52 +258,63 @@ trainer = MyTrainer(
     train_dataset=encoded_train,
     eval_dataset=encoded_valid,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep,
+    callbacks=[DivergenceCallback()] + best_weights
 )
+if args.pack_length:
+    trainer.use_packing(args.pack_length, lr_scaling=args.lr_scaling)
+elif args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 # Default objective is the sum of all metrics
 # when metrics are provided, so we have to maximize it.
 best_run1 = trainer.hyperparameter_search(
     direction="maximize",
     backend='optuna',
-    n_trials=30,  # number of trials
-    hp_space=optuna
+    n_trials=args.n_trials,  # number of trials
+    hp_space=optuna,
+    target=args.target,
+    population=args.pbt,
+    workers=args.workers,
+    sampler=make_sampler(args.sampler),
+    deduplicate=args.dedup,
+    **warm_start.study_kwargs(s)
 )
 
 
 
 # SPLIT DATA (seed = 10)
 s = 10
-dataset2 = dataset1.train_test_split(test_size=0.1666666666666, seed=s, stratify_by_column='label')
-
-train = dataset2["train"]
-valid = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["train"]
-test = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["test"]
-
+train_rows, valid_test_rows = split_indices(dataset1, 0.1666666666666, s, 'label')
+valid_rows, test_rows = split_indices(dataset1, 0.5, s, 'label', rows=valid_test_rows)
 
-
-encoded_train = train.map(preprocess_function, batched=True)
-encoded_valid = valid.map(preprocess_function, batched=True)
-encoded_test = test.map(preprocess_function, batched=True)
+encoded_train = encoded_dataset1.select(train_rows)
+encoded_valid = encoded_dataset1.select(valid_rows)
+encoded_test = encoded_dataset1.select(test_rows)
 
 # Hyperparameter Search
-matthews = [-3]
-id = [-1]
 # Evaluate during training and a bit more often
 # than the default to be able to prune bad trials early.
 # Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments("2", do_eval=True,
+run_dir = make_run_dir(args.run_root, warm_start.study_name(s))
+training_args = MyTrainingArguments(run_dir, do_eval=True,
                                     eval_steps=500,
                                     optim=optim,
                                     per_device_train_batch_size=4,
                                     per_device_eval_batch_size=4,
+                                    group_by_length=args.group_by_length,
                                     evaluation_strategy="steps",
                                     logging_steps=500,
+                                    save_strategy="steps" if args.best_weights == 'disk' else "no",
                                     save_total_limit=2,
                                     warmup_steps=500,
                                     num_train_epochs=10,
-                                    load_best_model_at_end=True,
-                                    logging_dir="2",
+                                    load_best_model_at_end=args.best_weights == 'disk',
+                                    logging_dir=run_dir,
                                     disable_tqdm=False,
                                     )
 
@@ -236,51 +324,62 @@ trainer = MyTrainer(
     train_dataset=encoded_train,
     eval_dataset=encoded_valid,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep,
+    callbacks=[DivergenceCallback()] + best_weights
 )
+if args.pack_length:
+    trainer.use_packing(args.pack_length, lr_scaling=args.lr_scaling)
+elif args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 # Default objective is the sum of all metrics
 # when metrics are provided, so we have to maximize it.
 best_run2 = trainer.hyperparameter_search(
     direction="maximize",
     backend='optuna',
-    n_trials=30,  # number of trials
-    hp_space=optuna
+    n_trials=args.n_trials,  # number of trials
+    hp_space=optuna,
+    target=args.target,
+    population=args.pbt,
+    workers=args.workers,
+    sampler=make_sampler(args.sampler),
+    deduplicate=args.dedup,
+    **warm_start.study_kwargs(s)
 )
 
 
 # SPLIT DATA (seed = 100)
 s = 100
-dataset2 = dataset1.train_test_split(test_size=0.1666666666666, seed=s, stratify_by_column='label')
-
-train = dataset2["train"]
-valid = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["train"]
-test = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["test"]
+train_rows, valid_test_rows = split_indices(dataset1, 0.1666666666666, s, 'label')
+valid_rows, test_rows = split_indices(dataset1, 0.5, s, 'label', rows=valid_test_rows)
 
-
-
-encoded_train = train.map(preprocess_function, batched=True)
-encoded_valid = valid.map(preprocess_function, batched=True)
-encoded_test = test.map(preprocess_function, batched=True)
+encoded_train = encoded_dataset1.select(train_rows)
+encoded_valid = encoded_dataset1.select(valid_rows)
+encoded_test = encoded_dataset1.select(test_rows)
 
 # Hyperparameter Search
-matthews = [-3]
-id = [-1]
 # Evaluate during training and a bit more often
 # than the default to be able to prune bad trials early.
 # Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments("3", do_eval=True,
+run_dir = make_run_dir(args.run_root, warm_start.study_name(s))
+training_args = MyTrainingArguments(run_dir, do_eval=True,
                                     eval_steps=500,
                                     optim=optim,
                                     per_device_train_batch_size=4,
                                     per_device_eval_batch_size=4,
+                                    group_by_length=args.group_by_length,
                                     evaluation_strategy="steps",
                                     logging_steps=500,
+                                    save_strategy="steps" if args.best_weights == 'disk' else "no",
                                     save_total_limit=2,
                                     warmup_steps=500,
                                     num_train_epochs=10,
-                                    load_best_model_at_end=True,
-                                    logging_dir="3",
+                                    load_best_model_at_end=args.best_weights == 'disk',
+                                    logging_dir=run_dir,
                                     disable_tqdm=False,
                                     )
 
@@ -290,51 +389,62 @@ trainer = MyTrainer(
     train_dataset=encoded_train,
     eval_dataset=encoded_valid,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep,
+    callbacks=[DivergenceCallback()] + best_weights
 )
+if args.pack_length:
+    trainer.use_packing(args.pack_length, lr_scaling=args.lr_scaling)
+elif args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 # Default objective is the sum of all metrics
 # when metrics are provided, so we have to maximize it.
 best_run3 = trainer.hyperparameter_search(
     direction="maximize",
     backend='optuna',
-    n_trials=30,  # number of trials
-    hp_space=optuna
+    n_trials=args.n_trials,  # number of trials
+    hp_space=optuna,
+    target=args.target,
+    population=args.pbt,
+    workers=args.workers,
+    sampler=make_sampler(args.sampler),
+    deduplicate=args.dedup,
+    **warm_start.study_kwargs(s)
 )
 
 
 # SPLIT DATA (seed = 1000)
 s = 1000
-dataset2 = dataset1.train_test_split(test_size=0.1666666666666, seed=s, stratify_by_column='label')
-
-train = dataset2["train"]
-valid = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["train"]
-test = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["test"]
-
-
+train_rows, valid_test_rows = split_indices(dataset1, 0.1666666666666, s, 'label')
+valid_rows, test_rows = split_indices(dataset1, 0.5, s, 'label', rows=valid_test_rows)
 
-encoded_train = train.map(preprocess_function, batched=True)
-encoded_valid = valid.map(preprocess_function, batched=True)
-encoded_test = test.map(preprocess_function, batched=True)
+encoded_train = encoded_dataset1.select(train_rows)
+encoded_valid = encoded_dataset1.select(valid_rows)
+encoded_test = encoded_dataset1.select(test_rows)
 
 # Hyperparameter Search
-matthews = [-3]
-id = [-1]
 # Evaluate during training and a bit more often
 # than the default to be able to prune bad trials early.
 # Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments("4", do_eval=True,
+run_dir = make_run_dir(args.run_root, warm_start.study_name(s))
+training_args = MyTrainingArguments(run_dir, do_eval=True,
                                     eval_steps=500,
                                     optim=optim,
                                     per_device_train_batch_size=4,
                                     per_device_eval_batch_size=4,
+                                    group_by_length=args.group_by_length,
                                     evaluation_strategy="steps",
                                     logging_steps=500,
+                                    save_strategy="steps" if args.best_weights == 'disk' else "no",
                                     save_total_limit=2,
                                     warmup_steps=500,
                                     num_train_epochs=10,
-                                    load_best_model_at_end=True,
-                                    logging_dir="4",
+                                    load_best_model_at_end=args.best_weights == 'disk',
+                                    logging_dir=run_dir,
                                     disable_tqdm=False,
                                     )
 
@@ -344,51 +454,62 @@ trainer = MyTrainer(
     train_dataset=encoded_train,
     eval_dataset=encoded_valid,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep,
+    callbacks=[DivergenceCallback()] + best_weights
 )
+if args.pack_length:
+    trainer.use_packing(args.pack_length, lr_scaling=args.lr_scaling)
+elif args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 # Default objective is the sum of all metrics
 # when metrics are provided, so we have to maximize it.
 best_run4 = trainer.hyperparameter_search(
     direction="maximize",
     backend='optuna',
-    n_trials=30,  # number of trials
-    hp_space=optuna
+    n_trials=args.n_trials,  # number of trials
+    hp_space=optuna,
+    target=args.target,
+    population=args.pbt,
+    workers=args.workers,
+    sampler=make_sampler(args.sampler),
+    deduplicate=args.dedup,
+    **warm_start.study_kwargs(s)
 )
 
 
 # SPLIT DATA (seed = 10000)
 s = 10000
-dataset2 = dataset1.train_test_split(test_size=0.1666666666666, seed=s, stratify_by_column='label')
+train_rows, valid_test_rows = split_indices(dataset1, 0.1666666666666, s, 'label')
+valid_rows, test_rows = split_indices(dataset1, 0.5, s, 'label', rows=valid_test_rows)
 
-train = dataset2["train"]
-valid = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["train"]
-test = dataset2["test"].train_test_split(test_size=0.5, seed=s, stratify_by_column='label')["test"]
-
-
-
-encoded_train = train.map(preprocess_function, batched=True)
-encoded_valid = valid.map(preprocess_function, batched=True)
-encoded_test = test.map(preprocess_function, batched=True)
+encoded_train = encoded_dataset1.select(train_rows)
+encoded_valid = encoded_dataset1.select(valid_rows)
+encoded_test = encoded_dataset1.select(test_rows)
 
 # Hyperparameter Search
-matthews = [-3]
-id = [-1]
 # Evaluate during training and a bit more often
 # than the default to be able to prune bad trials early.
 # Disabling tqdm is a matter of preference.
-training_args = MyTrainingArguments("5", do_eval=True,
+run_dir = make_run_dir(args.run_root, warm_start.study_name(s))
+training_args = MyTrainingArguments(run_dir, do_eval=True,
                                     eval_steps=500,
                                     optim=optim,
                                     per_device_train_batch_size=4,
                                     per_device_eval_batch_size=4,
+                                    group_by_length=args.group_by_length,
                                     evaluation_strategy="steps",
                                     logging_steps=500,
+                                    save_strategy="steps" if args.best_weights == 'disk' else "no",
                                     save_total_limit=2,
                                     warmup_steps=500,
                                     num_train_epochs=10,
-                                    load_best_model_at_end=True,
-                                    logging_dir="5",
+                                    load_best_model_at_end=args.best_weights == 'disk',
+                                    logging_dir=run_dir,
                                     disable_tqdm=False,
                                     )
 
@@ -398,16 +519,31 @@ trainer = MyTrainer(
     train_dataset=encoded_train,
     eval_dataset=encoded_valid,
     model_init=model_init,
-    compute_metrics=compute_metrics
+    compute_metrics=compute_metrics,
+    keep_artifacts=args.keep,
+    callbacks=[DivergenceCallback()] + best_weights
 )
+if args.pack_length:
+    trainer.use_packing(args.pack_length, lr_scaling=args.lr_scaling)
+elif args.max_tokens:
+    trainer.use_token_budget(args.max_tokens, lr_scaling=args.lr_scaling)
+elif args.auto_batch_size:
+    trainer.find_batch_sizes(max_batch_size=args.max_batch_size, lr_scaling=args.lr_scaling,
+                             memory_limit=None if args.memory_limit is None else args.memory_limit * 2**30)
 
 # Default objective is the sum of all metrics
 # when metrics are provided, so we have to maximize it.
 best_run5 = trainer.hyperparameter_search(
     direction="maximize",
     backend='optuna',
-    n_trials=30,  # number of trials
-    hp_space=optuna
+    n_trials=args.n_trials,  # number of trials
+    hp_space=optuna,
+    target=args.target,
+    population=args.pbt,
+    workers=args.workers,
+    sampler=make_sampler(args.sampler),
+    deduplicate=args.dedup,
+    **warm_start.study_kwargs(s)
 )
 
 if only_lr:
@@ -415,7 +551,7 @@ if only_lr:
 else:
     params = 'all hyperparameters'
 
-f = open(task + '_'+ args.model + '_' + args.optim +'_bestruns.txt', 'w')
+f = open(result_files[0], 'w')
 
 f.write("for seed: "+str(1) + '\n')
 f.write(str(best_run1) + '\n')
@@ -427,5 +563,15 @@ f.write("for seed: "+str(1000) + '\n')
 f.write(str(best_run4) + '\n')
 f.write("for seed: "+str(10000) + '\n')
 f.write(str(best_run5) + '\n')
+f.write(warm_start.report())
 f.write( params + " tuned")
-f.close()
\ No newline at end of file
+f.close()
+
+# the hyperparameters of every seed, for the train scripts (--hparams), the fastest of the Pareto front with --target
+best_runs = {1: best_run1, 10: best_run2, 100: best_run3, 1000: best_run4, 10000: best_run5}
+with open(result_files[1], 'w') as f:
+    json.dump({str(seed): (run[0] if isinstance(run, list) else run).hyperparameters for seed, run in best_runs.items()},
+              f, indent=2)
+
+if args.cache:
+    store_result(args.cache, run_key, result_config, result_files)
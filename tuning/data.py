@@ -0,0 +1,41 @@
+import numpy as np
+from datasets import Dataset, Features, Value
+
+
+def split_indices(dataset, test_size, seed, stratify_by_column=None, rows=None):
+    """
+    Returns the row numbers of the two splits `dataset.train_test_split(test_size, seed=seed,
+    stratify_by_column=stratify_by_column)` would make, in the same order, without touching any column but the labels.
+    With `rows`, only these rows of `dataset` are split, as `dataset.select(rows).train_test_split(...)` would do,
+    and row numbers of `dataset` are returned.
+
+    The splits of every seed can then be taken as `select` views of a dataset tokenized once.
+    """
+    rows = np.arange(len(dataset)) if rows is None else np.asarray(rows)
+    columns = {"row": rows}
+    features = {"row": Value("int64")}
+    if stratify_by_column is not None:
+        columns[stratify_by_column] = np.asarray(dataset[stratify_by_column])[rows]
+        features[stratify_by_column] = dataset.features[stratify_by_column]
+    split = Dataset.from_dict(columns, features=Features(features)).train_test_split(
+        test_size=test_size, seed=seed, stratify_by_column=stratify_by_column)
+    return split["train"]["row"], split["test"]["row"]
+
+
+class EncodedRows:
+    """
+    `dataset.select(rows).map(function, batched=True)` computed once for the union of the rows every seed uses, so
+    that `select(rows)` returns the encoded rows of a seed as a view, without tokenizing them again. The map is done by
+    `encode(dataset, function)` if given, e.g. [`~encoding_cache.cached_map`].
+    """
+
+    def __init__(self, dataset, function, rows, encode=None):
+        self.rows = sorted(set(rows))
+        self.positions = {row: i for i, row in enumerate(self.rows)}
+        if encode is None:
+            self.encoded = dataset.select(self.rows).map(function, batched=True)
+        else:
+            self.encoded = encode(dataset.select(self.rows), function)
+
+    def select(self, rows):
+        return self.encoded.select([self.positions[row] for row in rows])
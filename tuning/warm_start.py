@@ -0,0 +1,223 @@
+import optuna
+
+# optimizers whose search spaces share dimensions (`learning_rate`, `adam_beta1`, `adam_beta2`, `adam_epsilon` for the
+# adam family and adabound, whose `final_lr` and `gamma` are left to its sampler, `learning_rate` for sgd), so a tuned
+# study of one is a good prior for the others
+related_optimizers = {
+    'adam': ['adamw', 'nadam', 'adamax'],
+    'adamw': ['adam', 'nadam', 'adamax'],
+    'nadam': ['adam', 'adamw', 'adamax'],
+    'adamax': ['adam', 'adamw', 'nadam'],
+    'adabound': ['adam', 'adamw'],
+    'sgd': ['sgdm'],
+    'sgdm': ['sgd'],
+}
+
+
+def study_prefix(task, model, optim, only_lr, target=None):
+    prefix = '_'.join([task, model, optim, 'lr' if only_lr else 'all'])
+    if target is not None:
+        prefix += '_target_' + str(target)
+    return prefix
+
+
+def related_prefixes(task, model, optim, target=None):
+    """
+    Returns the name prefixes of the studies of the optimizers related to `optim`, tuned with either search space.
+    """
+    return [study_prefix(task, model, o, only_lr, target)
+            for o in related_optimizers[optim] for only_lr in (False, True)]
+
+
+class _SpaceTrial(optuna.trial.FixedTrial):
+    # a `FixedTrial` giving every hyperparameter its lowest value (or first choice), so a search space can be run
+    # without a study
+    def __init__(self):
+        super().__init__({})
+
+    def _suggest(self, name, distribution):
+        if isinstance(distribution, optuna.distributions.CategoricalDistribution):
+            self._params[name] = distribution.choices[0]
+        else:
+            self._params[name] = distribution.low
+        return super()._suggest(name, distribution)
+
+
+def hp_names(hp_space):
+    """
+    Returns the names of the hyperparameters sampled by `hp_space`.
+    """
+    return list(hp_space(_SpaceTrial()).keys())
+
+
+# multi-objective studies (see `BaseTrainer.hyperparameter_search`) are ranked by their first objective, the metric
+
+
+def is_better(study, value, target):
+    if study.directions[0] == optuna.study.StudyDirection.MAXIMIZE:
+        return value >= target
+    return value <= target
+
+
+def best_value(study):
+    values = [t.values[0] for t in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))]
+    if study.directions[0] == optuna.study.StudyDirection.MAXIMIZE:
+        return max(values)
+    return min(values)
+
+
+def best_trials(studies, k, names=None):
+    """
+    Returns the parameters of the ``k`` best completed trials over all the given studies, best first.
+    Identical configurations are returned once.
+
+    Args:
+        studies (`List[optuna.Study]`): The studies to take the trials from. They are expected to share a direction.
+        k (`int`): The number of configurations to return.
+        names (`List[str]`, *optional*):
+            Only keep these hyperparameters, the others are left to the sampler of the study they are enqueued in.
+    """
+    trials = []
+    for study in studies:
+        trials += study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))
+    if not trials or k <= 0:
+        return []
+    maximize = studies[0].directions[0] == optuna.study.StudyDirection.MAXIMIZE
+    trials = sorted(trials, key=lambda t: t.values[0], reverse=maximize)
+
+    params = []
+    for trial in trials:
+        p = {n: v for n, v in trial.params.items() if names is None or n in names}
+        if p and p not in params:
+            params.append(p)
+        if len(params) == k:
+            break
+    return params
+
+
+def trials_to_target(study, target):
+    """
+    Returns how many trials `study` ran until one of them reached `target`, or `None` if none did.
+    """
+    trials = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,
+                                                       optuna.trial.TrialState.PRUNED,
+                                                       optuna.trial.TrialState.FAIL))
+    for i, trial in enumerate(sorted(trials, key=lambda t: t.number)):
+        if trial.state == optuna.trial.TrialState.COMPLETE and is_better(study, trial.values[0], target):
+            return i + 1
+    return None
+
+
+class SeedWarmStart:
+    """
+    Chains the per-seed studies of a tuning script: the study of every new seed starts by evaluating the ``top_k``
+    best configurations found on the seeds tuned before it, so TPE starts from the known good region instead of
+    rediscovering it, and fewer trials per seed are needed.
+
+    Studies of related optimizers on the same task, model and seed that are already in `storage` (see
+    `related_optimizers`) can be used the same way with ``transfer_k``. The studies with transferred trials are kept
+    apart from the ones tuned without, so `report` can compare them with a cold study of the same optimizer.
+
+    Args:
+        name (`str`):
+            Prefix of the study names, the study of seed `s` is called `<name>_seed_<s>`, or `<name>_transfer_seed_<s>`
+            with ``transfer_k``.
+        top_k (`int`, *optional*, defaults to 0):
+            How many of the best configurations of the previous seeds are enqueued in the next study. `0` disables
+            warm starting, every seed is then tuned from scratch as before.
+        storage (`str` or `optuna.storages.BaseStorage`, *optional*):
+            Where the studies are kept. Defaults to an in-memory storage that lives as long as this object. Transfer
+            between optimizers needs a persistent one, e.g. `sqlite:///studies.db`.
+        related (`List[str]`, *optional*):
+            Name prefixes of the studies of related optimizers.
+        transfer_k (`int`, *optional*, defaults to 0):
+            How many of the best configurations of every related study of the same seed are enqueued.
+        hp_space (`Callable`, *optional*):
+            The search space of the tuned optimizer. Transferred configurations are restricted to its hyperparameters.
+        directions (`List[str]`, *optional*, defaults to `["maximize"]`):
+            The directions of the studies, two for the multi-objective search of `BaseTrainer.hyperparameter_search`.
+    """
+
+    def __init__(self, name, top_k=0, storage=None, related=(), transfer_k=0, hp_space=None, directions=("maximize",)):
+        self.name = name
+        self.directions = list(directions)
+        self.top_k = top_k
+        self.storage = optuna.storages.InMemoryStorage() if storage is None else storage
+        self.related = related
+        self.transfer_k = transfer_k
+        self.names = hp_names(hp_space) if hp_space is not None else None
+        self.studies = []
+        self.sources = {}
+
+    def study_name(self, seed):
+        return self.name + ('_transfer' if self.transfer_k else '') + '_seed_' + str(seed)
+
+    def load_studies(self, names):
+        # the studies of `names` in the storage that completed trials
+        studies = []
+        for name in names:
+            try:
+                study = optuna.load_study(study_name=name, storage=self.storage)
+            except KeyError:
+                continue
+            if study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)):
+                studies.append(study)
+        return studies
+
+    def related_studies(self, seed):
+        return self.load_studies(name + suffix + '_seed_' + str(seed)
+                                 for name in self.related for suffix in ('', '_transfer'))
+
+    def cold_study(self, seed):
+        """
+        The study of the same optimizer and seed tuned without transferred trials, or `None` if there is none.
+        """
+        studies = self.load_studies([self.name + '_seed_' + str(seed)])
+        return studies[0] if studies else None
+
+    def study_kwargs(self, seed):
+        """
+        Creates the study of `seed`, enqueues the warm start trials in it and returns the keyword arguments that make
+        `Trainer.hyperparameter_search` run on it.
+        """
+        study_name = self.study_name(seed)
+        study = optuna.create_study(study_name=study_name, storage=self.storage, directions=self.directions,
+                                    load_if_exists=True)
+        sources = self.related_studies(seed) if self.transfer_k else []
+        for params in best_trials(self.studies, self.top_k) + best_trials(sources, self.transfer_k, self.names):
+            study.enqueue_trial(params, skip_if_exists=True)
+        self.studies.append(study)
+        self.sources[seed] = (study, sources)
+        return {"study_name": study_name, "storage": self.storage, "load_if_exists": True}
+
+    def report(self):
+        """
+        Describes, for every seed with transferred trials, how many trials the study needed to reach the best value of
+        the cold study of the same optimizer and seed (see `cold_study`), compared with the trials the cold study
+        needed, i.e. how much of the budget the transfer saved. Without a cold study in the storage, only the trials
+        the study ran until its best value are given.
+        """
+        lines = []
+        for seed, (study, sources) in self.sources.items():
+            if not sources:
+                continue
+            line = "transfer for seed " + str(seed) + " from " + ", ".join(s.study_name for s in sources) + ": "
+            cold = self.cold_study(seed)
+            if not study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)):
+                line += "no completed trial"
+            elif cold is None:
+                target = best_value(study)
+                line += "best value " + str(target) + " reached after " + str(trials_to_target(study, target)) + \
+                        " trials, no cold study of " + self.name + '_seed_' + str(seed) + " to compare with"
+            else:
+                target = best_value(cold)
+                warm = trials_to_target(study, target)
+                if warm is None:
+                    line += "best cold value " + str(target) + " not reached"
+                else:
+                    cold_trials = trials_to_target(cold, target)
+                    line += "best cold value " + str(target) + " reached after " + str(warm) + \
+                            " trials instead of " + str(cold_trials) + \
+                            " (" + "{:.0f}%".format(100 * (1 - warm / cold_trials)) + " of the budget saved)"
+            lines.append(line + '\n')
+        return ''.join(lines)